@@ -4,6 +4,8 @@
 import json
 import string
 
+from itertools_recipes import combination_unrank
+
 def tab_sep(data):
     return string.join(data, '\t')
 
@@ -35,6 +37,19 @@ def read_json_file(filename):
     input_file = open(filename, 'r')
     return json.load(input_file)
 
+def decode_combo(data, group, combo):
+    '''Given JSON data from run_all_combos, return a combo's node names.
+
+    @param data: JSON data; has combo_nodes if written with --combo_format rank.
+    @param group: number of controllers, as a string.
+    @param combo: list of node names, or rank in combinations(combo_nodes, k).
+    @return combo: list of node names
+    '''
+    if not isinstance(combo, int):
+        return list(combo)
+    nodes = data['combo_nodes']
+    return [nodes[i] for i in combination_unrank(combo, len(nodes), int(group))]
+
 def write_csv_file(filename, data, exclude):
     '''Given JSON data, convert to CSV and write to file.'''
     csv_file = open(filename + ".csv", 'w')
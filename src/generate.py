@@ -7,6 +7,7 @@ import networkx as nx
 
 import lib.plot as plot
 import metrics
+import metrics_lib
 import plot_cdfs
 import plot_ranges
 import plot_cloud
@@ -21,12 +22,12 @@ if __name__ == "__main__":
     global options
     options = plot.parse_args()
 
-    def do_all(name, g, i, t, data):
+    def do_all(name, g, i, t, data, context):
         global options
         assert options
         filename = ''
         if 'metrics' in options.operations:
-            stats, filename = metrics.do_metrics(options, name, g)
+            stats, filename = metrics.do_metrics(options, name, g, context)
             filename = filename.replace('data_out', 'data_vis')
         else:
             controllers = metrics.get_controllers(g, options)
@@ -53,41 +54,52 @@ if __name__ == "__main__":
     else:
         topos = options.topos
 
+    # One worker pool for every topology, rather than one per topology.
+    context = None
+    if options.multiprocess and 'metrics' in options.operations:
+        context = metrics_lib.ExecutionContext(options.processes)
+
     t = len(topos)
     ignored = []
     successes = []
-    for i, topo in enumerate(topos):
-        if not options.max == None and i >= options.max:
-            break
+    try:
+        for i, topo in enumerate(topos):
+            if not options.max == None and i >= options.max:
+                break
 
-        print("topo %s of %s: %s" % (i + 1, t, topo))
-        g, usable, note = get_topo_graph(topo)
-        cc = nx.number_connected_components(g)
-        controllers = metrics.get_controllers(g, options)
-        exp_filename = metrics.get_filename(topo, options, controllers)
+            print("topo %s of %s: %s" % (i + 1, t, topo))
+            g, usable, note = get_topo_graph(topo)
+            cc = nx.number_connected_components(g)
+            controllers = metrics.get_controllers(g, options)
+            exp_filename = metrics.get_filename(topo, options, controllers)
 
-        if not g:
-            raise Exception("WTF?  null graph: %s" % topo)
+            if not g:
+                raise Exception("WTF?  null graph: %s" % topo)
 
-        if options.topos_blacklist and topo in options.topos_blacklist:
-            print("ignoring topo %s - in blacklist" % topo)
-            ignored.append(topo)
-        elif cc != 1:  # Ignore multiple-CC topos, which confuse APSP calcs
-            print("ignoring topo, cc != 1: %s" % topo)
-            ignored.append(topo)
-        elif g.number_of_nodes() < len(controllers):
-            print("skipping topo, c >= n: %s" % topo)
-            ignored.append(topo)
-        elif not options.force and os.path.exists(exp_filename + '.json'):
-            # Don't bother doing work if our metrics are already there.
-            print("skipping already-analyzed topo: %s" % topo)
-            ignored.append(topo)
-        elif not has_weights(g):
-            ignored.append(topo)
-            print("no weights for %s, skipping" % topo)
-        else:
-            do_all(topo, g, 1, 1, None)
-            successes.append(topo)
+            if options.topos_blacklist and topo in options.topos_blacklist:
+                print("ignoring topo %s - in blacklist" % topo)
+                ignored.append(topo)
+            elif cc != 1:  # Ignore multiple-CC topos, which confuse APSP calcs
+                print("ignoring topo, cc != 1: %s" % topo)
+                ignored.append(topo)
+            elif g.number_of_nodes() < len(controllers):
+                print("skipping topo, c >= n: %s" % topo)
+                ignored.append(topo)
+            elif not options.force and os.path.exists(exp_filename + '.json'):
+                # Don't bother doing work if our metrics are already there.
+                print("skipping already-analyzed topo: %s" % topo)
+                ignored.append(topo)
+            elif not has_weights(g):
+                ignored.append(topo)
+                print("no weights for %s, skipping" % topo)
+            else:
+                do_all(topo, g, 1, 1, None, context)
+                successes.append(topo)
+    finally:
+        # Stop the workers and free the last topology's shared state, even
+        # if a topology fails.
+        if context:
+            context.close()
 
     print("successes: %s of %s: %s" % (len(successes), t, successes))
     print("ignored: %s of %s: %s" % (len(ignored), t, ignored))
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 '''See http://docs.python.org/library/itertools.html'''
 
+from itertools import combinations, islice
 import random
 
 def random_combination(iterable, r):
@@ -27,3 +28,133 @@ def choose(n, k):
         return ntok // ktok
     else:
         return 0
+
+# Combinatorial number system: the position of a combination in
+# itertools.combinations(range(n), k), which is lexicographic order.
+def combination_rank(combo, n):
+    '''Returns the index of combo in itertools.combinations(range(n), k).
+
+    @param combo: sorted sequence of k distinct elements of range(n)
+    @param n: number of elements
+    @return rank: integer in [0, choose(n, k))
+    '''
+    k = len(combo)
+    rank = 0
+    prev = -1
+    for i, c in enumerate(combo):
+        # Count the combos sharing combo[:i], with a smaller element at i.
+        for v in range(prev + 1, c):
+            rank += choose(n - v - 1, k - i - 1)
+        prev = c
+    return rank
+
+
+def combination_unrank(rank, n, k):
+    '''Returns the combination at index rank of itertools.combinations(range(n), k).
+
+    @param rank: integer in [0, choose(n, k))
+    @param n: number of elements
+    @param k: elements per combination
+    @return combo: sorted k-tuple
+    '''
+    if not 0 <= rank < choose(n, k):
+        raise Exception("rank %s out of range for %s choose %s" % (rank, n, k))
+    combo = []
+    v = 0
+    for i in range(k):
+        # Skip past every block of combos whose element i is too small.
+        while True:
+            block = choose(n - v - 1, k - i - 1)
+            if rank < block:
+                break
+            rank -= block
+            v += 1
+        combo.append(v)
+        v += 1
+    return tuple(combo)
+
+
+def combinations_from(start, n):
+    '''Yield combinations(range(n), len(start)) from start onwards.
+
+    @param start: sorted tuple; the first combination to yield
+    @param n: number of elements
+    '''
+    k = len(start)
+    if k == 0:
+        yield ()
+        return
+    first = start[0]
+    for rest in combinations_from(start[1:], n):
+        yield (first,) + rest
+    for f in range(first + 1, n - k + 1):
+        for rest in combinations(range(f + 1, n), k - 1):
+            yield (f,) + rest
+
+
+def combinations_range(n, k, lo, hi):
+    '''Yield combinations(range(n), k)[lo:hi] without enumerating those before lo.
+
+    @param n: number of elements
+    @param k: elements per combination
+    @param lo: rank of the first combination
+    @param hi: rank one past the last combination
+    '''
+    if lo >= hi:
+        return iter([])
+    return islice(combinations_from(combination_unrank(lo, n, k), n), hi - lo)
+
+
+def revolving_door_combinations(n, k):
+    '''Yield all k-combinations of range(n) in revolving-door order.
+
+    Consecutive combinations differ by exactly one element swapped out and
+    one swapped in.  Algorithm R from Knuth, TAOCP Vol. 4A, 7.2.1.3.
+
+    @param n: number of elements
+    @param k: elements per combination
+    @return combos: iterator of sorted k-tuples
+    '''
+    if k < 0 or k > n:
+        return
+    if k == 0 or k == n:
+        yield tuple(range(k))
+        return
+    if k == 1:
+        for i in range(n):
+            yield (i,)
+        return
+    # c[1..k] is the current combination, in increasing order; c[k + 1] = n.
+    c = [None] + list(range(k)) + [n]
+    while True:
+        yield tuple(c[1:k + 1])
+        # Easy case: move c[1].
+        if k % 2 == 1:
+            if c[1] + 1 < c[2]:
+                c[1] += 1
+                continue
+            j = 2
+            try_decrease = True
+        else:
+            if c[1] > 0:
+                c[1] -= 1
+                continue
+            j = 2
+            try_decrease = False
+        while True:
+            if try_decrease:
+                # c[j] == c[j - 1] + 1 here.
+                if c[j] >= j:
+                    c[j] = c[j - 1]
+                    c[j - 1] = j - 2
+                    break
+                j += 1
+            # c[j - 1] == j - 2 here.
+            if c[j] + 1 < c[j + 1]:
+                c[j - 1] = c[j]
+                c[j] += 1
+                break
+            j += 1
+            if j > k:
+                return
+            try_decrease = True
@@ -102,6 +102,23 @@ def parse_args():
     opts.add_option("--write_dist",  action = "store_true",
                     default = False,
                     help = "write_distribution?")
+    opts.add_option("--dist_format", type = 'choice',
+                    choices = metrics.DIST_FORMATS,
+                    default = metrics.DIST_FORMATS[0],
+                    help = "format of the distribution written with "
+                    "--write_dist, one in %s" % metrics.DIST_FORMATS)
+    opts.add_option("--combo_format", type = 'choice',
+                    choices = metrics.COMBO_FORMATS,
+                    default = metrics.COMBO_FORMATS[0],
+                    help = "how to write combos, one in %s; rank writes "
+                    "each combo as its lexicographic rank over sorted node "
+                    "names" % metrics.COMBO_FORMATS)
+    opts.add_option("--max_failures", type = 'int', default = None,
+                    help = "max # simultaneous link failures for availability;"
+                    " defaults to 2 without --coverage_target")
+    opts.add_option("--coverage_target", type = 'float', default = None,
+                    help = "enumerate link failures until this fraction of "
+                    "failure probability is covered, e.g. 0.999999999")
     opts.add_option("--write_csv",  action = "store_true",
                     default = False,
                     help = "write csv file?")
@@ -118,9 +135,29 @@ def parse_args():
     opts.add_option("--no-compute_end",  action = "store_false",
                     default = True, dest = 'compute_end',
                     help = "don't compute metrics from end?")
+    opts.add_option("--enumeration", type = 'choice',
+                    choices = metrics.ENUMERATIONS,
+                    default = metrics.ENUMERATIONS[0],
+                    help = "order to enumerate combinations, one in %s" %
+                    metrics.ENUMERATIONS)
+    opts.add_option("--solver", type = 'choice',
+                    choices = metrics.SOLVERS,
+                    default = metrics.SOLVERS[0],
+                    help = "how to find optimal combos, one in %s; all but "
+                    "'enumerate' only compute lowest values" % metrics.SOLVERS)
+    opts.add_option("--resume",  action = "store_true",
+                    default = False,
+                    help = "continue an interrupted run from its checkpoint,"
+                    " and checkpoint this one?")
+    opts.add_option("--checkpoint_interval", type = 'float', default = None,
+                    help = "checkpoint a run, at most this many seconds "
+                    "apart; default %s with --resume, else no checkpoints. "
+                    "With --write_dist, needs --dist_format npy or "
+                    "histogram" % metrics.CHECKPOINT_INTERVAL)
     opts.add_option("--median",  action = "store_true",
                     default = False,
-                    help = "compute median?")
+                    help = "compute median and percentiles %s, from a "
+                    "bounded-memory sketch?" % metrics.PERCENTILES)
     opts.add_option("-f", "--force", action = "store_true",
                     default = False,
                     help = "force operations to occur even if metrics are there")
@@ -3,7 +3,6 @@
 import errno
 import os
 import json
-from operator import itemgetter
 from lib.dist import MILES_TO_MS, LATENCY_LINES
 
 # See http://matplotlib.sourceforge.net/users/customizing.html
@@ -75,9 +74,83 @@ from lib.options import parse_args, DPI
 
 import matplotlib.pyplot as plt
 import networkx as nx
+import numpy
 import pylab
 
 
+def is_columnar(distribution):
+    '''Is distribution a set of .npy columns, as written with --dist_format npy?'''
+    return isinstance(distribution, dict) and distribution.get('format') == 'npy'
+
+
+def is_histogram(values):
+    '''Is values a fixed-bin histogram, as written with --dist_format histogram?'''
+    return isinstance(values, dict) and not is_columnar(values)
+
+
+def load_column(distribution, column):
+    '''Memory-maps one column of a columnar distribution, without reading it.'''
+    values = numpy.load(distribution['columns'][column], mmap_mode = 'r')
+    return values[:distribution['rows']]
+
+
+def metric_distribution(stats, group, metric):
+    '''Returns the values of metric for group: a list, array, or histogram.'''
+    distribution = stats['data'][group]["distribution"]
+    if is_columnar(distribution):
+        return load_column(distribution, metric)
+    if is_histogram(distribution):
+        return distribution[metric]
+    return [d[metric] for d in distribution]
+
+
+def point_distribution(stats, group):
+    '''Returns the per-combo points for group, which histograms lack.
+
+    @return points: list of {id, combo, metric:value} dicts, or for columnar
+        distributions, a dict of column name to memory-mapped array.
+    '''
+    distribution = stats['data'][group]["distribution"]
+    if is_columnar(distribution):
+        return dict((column, load_column(distribution, column))
+                    for column in distribution['columns'])
+    if is_histogram(distribution):
+        raise Exception("per-combo points needed; rerun with --dist_format json")
+    return [d for d in distribution]
+
+
+def point_values(points, metric):
+    '''Returns the values of metric from point_distribution() points.'''
+    if isinstance(points, dict):
+        return points[metric]
+    return [d[metric] for d in points]
+
+
+def cdf_points(values):
+    '''Returns (x, y) CDF points for a list or array of values, or a histogram.'''
+    if isinstance(values, numpy.ndarray):
+        x = numpy.sort(values)
+        y = numpy.arange(1, len(x) + 1) / float(len(x))
+        return x, y
+    if is_histogram(values):
+        width = values['bin_width']
+        bins = sorted([(int(index), count)
+                       for index, count in values['counts'].items()])
+        total = float(sum([count for index, count in bins]))
+        x = []
+        y = []
+        seen = 0
+        for index, count in bins:
+            seen += count
+            # Every value in the bin is at most its upper edge.
+            x.append((index + 1) * width)
+            y.append(seen / total)
+        return x, y
+    x = sorted(values)
+    y = [(float(i + 1) / len(x)) for i in range(len(x))]
+    return x, y
+
+
 def load_stats(options):
     input_file = open(options.input, 'r')
     stats = json.load(input_file)
@@ -330,16 +403,16 @@ def pareto_data_raw(data, x_metric, y_metric, normalize,):
     datanames = []
     for i, k in enumerate(sorted(data.keys())):
         # Sort metrics by X
-        points_list = []
-        for d in data[k]:
-            points_list.append((d[x_metric], d[y_metric]))
-        lowest_y = None
-        pareto = []  # List of points on a pareto-optimal curve
-        sorted_by_x = sorted(points_list, key = itemgetter(0))
-        for x, y in sorted_by_x:
-            if not lowest_y or y < lowest_y:
-                pareto.append((x, y))
-                lowest_y = y
+        xs = numpy.asarray(point_values(data[k], x_metric), dtype = float)
+        ys = numpy.asarray(point_values(data[k], y_metric), dtype = float)
+        order = numpy.argsort(xs, kind = 'mergesort')
+        xs = xs[order]
+        ys = ys[order]
+        # Keep points whose y is below that of every point before them.
+        lowest_before = numpy.concatenate([[numpy.inf],
+                                           numpy.minimum.accumulate(ys)[:-1]])
+        keep = ys < lowest_before
+        pareto = list(zip(xs[keep].tolist(), ys[keep].tolist()))
 
         x = [d[0] for d in pareto]
         y = [d[1] for d in pareto]
@@ -375,7 +448,7 @@ def pareto_norm(stats, aspect_fcns, aspects, metric):
     '''
     data = {}
     for i, g in enumerate(stats['group']):
-        data[g] = [d for d in stats['data'][g]["distribution"]]
+        data[g] = point_distribution(stats, g)
         if not data[g]:
             raise Exception("missing distribution field in stats - check data")
 
@@ -486,8 +559,8 @@ def cloud(data, colors, axes, xscale, yscale,
     pylab.grid(True)
 
     for i, k in enumerate(sorted(data.keys(), reverse = True)):
-        x = [d[x_metric] for d in data[k]]
-        y = [d[y_metric] for d in data[k]]
+        x = point_values(data[k], x_metric)
+        y = point_values(data[k], y_metric)
         # Plot in reverse order, so choose colors in reverse order
         color = colors[len(data) - 1 - i]
         line = pylab.plot(x, y, 'o',
@@ -533,9 +606,7 @@ def plot(ptype, data, colors, axes, label, xscale, yscale,
     if ptype == 'cdf':
         index = 0
         for key in sorted(data.keys()):
-            val = data[key]
-            x = sorted(val)
-            y = [(float(i + 1) / len(x)) for i in range(len(x))]
+            x, y = cdf_points(data[key])
             lines.append(pylab.plot(x, y, colors[index]))
             datanames.append(key)
             index += 1
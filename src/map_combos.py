@@ -25,7 +25,7 @@ from mpl_toolkits.basemap import Basemap
 
 from os3e_weighted import OS3EWeightedGraph
 from os3e_weighted import LATLONG_FILE
-from file_libs import read_json_file
+from file_libs import read_json_file, decode_combo
 from topo_lib import get_topo_graph
 from metrics_lib import get_output_filepath
 
@@ -105,7 +105,8 @@ def do_plot(options, stats, g, write_filepath):
         data[str(c)] = stats['data'][str(c)]
         metric_data = []
         for metric in options.metrics:
-            metric_data.append(data[str(c)][metric]['lowest_combo'])
+            metric_data.append(decode_combo(stats, str(c),
+                                            data[str(c)][metric]['lowest_combo']))
         write_map(g, city_data, options.metrics, metric_data, write_filepath + str(c), options.write,
                   options.ext, options.labels, color = COLORS[i])
 
@@ -50,12 +50,16 @@ def get_filename(topo, options, controllers):
     return filename
 
 
-def get_extra_params(g):
+def get_extra_params(g, max_failures = None, coverage_target = None):
     # Additional args to pass to metrics functions.
     extra_params = {
         'link_fail_prob': 0.01,
-        'max_failures': 2
+        'max_failures': max_failures
     }
+    if coverage_target is not None:
+        extra_params['coverage_target'] = coverage_target
+    elif max_failures is None:
+        extra_params['max_failures'] = 2
 
     # Try to roughly match the failure probability of links.
     link_fail_prob = extra_params['link_fail_prob']
@@ -65,8 +69,12 @@ def get_extra_params(g):
     return extra_params
 
 
-def do_metrics(options, topo, g):
-    '''Compute the metrics for a single topology.'''
+def do_metrics(options, topo, g, context = None):
+    '''Compute the metrics for a single topology.
+
+    @param context: metrics_lib.ExecutionContext to reuse across calls, or
+        None to start a worker pool for this topology only.
+    '''
 
     print("==========options")
     print(options)
@@ -75,19 +83,37 @@ def do_metrics(options, topo, g):
     filename = get_filename(topo, options, controllers)
 
     data = {}  # See top for data schema details.
-    apsp = nx.all_pairs_dijkstra_path_length(g)
-    apsp_paths = nx.all_pairs_dijkstra_path(g)
+    apsp = dict(nx.all_pairs_dijkstra_path_length(g))
+    apsp_paths = dict(nx.all_pairs_dijkstra_path(g))
 
-    extra_params = get_extra_params(g)
+    extra_params = get_extra_params(g, options.max_failures,
+                                    options.coverage_target)
     if options.use_prior:
         data = read_json_file(filename)
+    elif options.solver != 'enumerate':
+        start = time.time()
+        metrics.run_solver(options.solver, options.metrics, g, controllers,
+                           data, apsp, options.processes,
+                           options.multiprocess, context)
+        total_duration = time.time() - start
+        print("%0.6f" % total_duration)
     else:
         start = time.time()
         weighted = True
+        checkpoint = None
+        checkpoint_interval = options.checkpoint_interval
+        if options.resume or checkpoint_interval is not None:
+            checkpoint = filename + '.checkpoint.json'
+            if checkpoint_interval is None:
+                checkpoint_interval = metrics.CHECKPOINT_INTERVAL
         metrics.run_all_combos(options.metrics, g, controllers, data, apsp,
                                apsp_paths, weighted, options.write_dist,
                                options.write_combos, extra_params, options.processes,
-                               options.multiprocess, options.chunksize, options.median)
+                               options.multiprocess, options.chunksize, options.median,
+                               options.enumeration, checkpoint,
+                               options.resume, checkpoint_interval,
+                               context, options.dist_format, filename + '_dist',
+                               options.combo_format)
         total_duration = time.time() - start
         print("%0.6f" % total_duration)
 
@@ -113,7 +139,7 @@ def do_metrics(options, topo, g):
         write_json_file(filename + '.json', data)
         if options.write_csv:
             write_csv_file(filename, data["data"], exclude = exclude)
-            if options.write_dist:
+            if options.write_dist and options.dist_format == 'json':
                 write_dist_csv_file(filename + '_dist', data["data"], exclude)
 
     return data, filename
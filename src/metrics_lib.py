@@ -1,22 +1,116 @@
 #!/usr/bin/env python
 '''Library of algorithms and helpers for computing metrics.'''
 
-from itertools import combinations
+from functools import partial
+from itertools import combinations, chain, groupby, islice
+import collections
+import json
 import logging
 import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
+import os
+import pickle
+import threading
 import time
 
 import numpy
 import networkx as nx
 import random
 import math
+from statistics import NormalDist
 
-from itertools_recipes import random_combination, choose
+from itertools_recipes import random_combination, choose, combinations_range
+from itertools_recipes import combination_rank
+from itertools_recipes import revolving_door_combinations
+from lib.graph import flatten
+from quantiles import QuantileSketch
 from util import sort_by_val
 
 BIG = 10000000
 RESULTS_TIMEOUT = 1
 COARSE = True  # Divide up tasks in the beginning, rather than fine-grained.
+USE_MATRIX = True  # Compute metrics over a dense distance matrix, not dicts.
+BATCH_SIZE = 4096  # Combos per block when evaluating combos in batches.
+IN_FLIGHT_PER_PROCESS = 4  # Max fine-grained tasks queued per worker.
+MILP_TIME_LIMIT = None  # Seconds before the MILP solver gives up; None for no limit.
+LAGRANGIAN_ITERATIONS = 500  # Max subgradient steps for the k-median bound.
+LAGRANGIAN_STEP = 2.0  # Initial subgradient step scale.
+LAGRANGIAN_PATIENCE = 20  # Steps without improvement before halving the step.
+LAGRANGIAN_TOLERANCE = 1e-9  # Relative gap at which a bound proves optimality.
+CHECKPOINT_COMBOS = 1 << 18  # Combos between chances to write a checkpoint.
+CHECKPOINT_INTERVAL = 300  # Min seconds between checkpoint writes.
+PERCENTILES = [1, 5, 95, 99]  # Reported along with the median, with --median.
+
+# Formats for the per-k distribution: a list of per-combo JSON points, a
+# fixed-bin histogram of each metric, or .npy column files.
+DIST_FORMATS = ['json', 'histogram', 'npy']
+# Histogram bin width per metric, in the metric's units; latencies get
+# widths scaled to the topology instead, see histogram_bin_widths.
+HISTOGRAM_BIN_WIDTHS = {
+    'null': 1.0,
+    'latency': 1.0,
+    'latency_2': 1.0,
+    'wc_latency': 1.0,
+    'wc_latency_2': 1.0,
+    'fairness': 0.0001,
+    'congestion': 0.0001,
+    'availability': 0.000001,
+    'availability_mc': 0.000001,
+    'availability_reroute': 0.000001
+}
+# Latency histograms split [0, diameter] into this many bins, so hop-count
+# and mileage graphs get the same resolution.
+HISTOGRAM_LATENCY_BINS = 10000
+LATENCY_METRICS = ['latency', 'latency_2', 'wc_latency', 'wc_latency_2']
+
+
+def histogram_bin_widths(diameter):
+    '''Returns the histogram bin width of each metric for one topology.
+
+    @param diameter: longest shortest-path length of the topology
+    '''
+    widths = dict(HISTOGRAM_BIN_WIDTHS)
+    if diameter > 0:
+        for metric in LATENCY_METRICS:
+            widths[metric] = float(diameter) / HISTOGRAM_LATENCY_BINS
+    return widths
+
+# Availability at each max # failures, as its own metric, e.g.
+# 'availability_2' for up to 2 simultaneous failures; one sweep serves all.
+MAX_DEPTH_METRIC = 4
+
+
+def depth_metric(failures):
+    '''Returns the name of the availability metric for one failure depth.'''
+    return 'availability_%i' % failures
+
+DEPTH_METRICS = [depth_metric(f) for f in range(1, MAX_DEPTH_METRIC + 1)]
+HISTOGRAM_BIN_WIDTHS.update(
+    (metric, HISTOGRAM_BIN_WIDTHS['availability']) for metric in DEPTH_METRICS)
+
+
+def metric_depth(metric):
+    '''Returns the failure depth of one of DEPTH_METRICS.'''
+    return DEPTH_METRICS.index(metric) + 1
+
+
+def depth_sweep(metrics):
+    '''Returns the deepest failure depth among metrics, or 0 if none.'''
+    return max([metric_depth(m) for m in metrics if m in DEPTH_METRICS] + [0])
+
+# Formats for combos in outputs: lists of node names, or the combo's
+# lexicographic rank in combinations(sorted node names, k); see
+# file_libs.decode_combo.
+COMBO_FORMATS = ['names', 'rank']
+# Defaults for the extra_params of sample_availability.
+MC_DEFAULTS = {
+    'mc_precision': 0.01,  # Target confidence interval half-width.
+    'mc_confidence': 0.95,  # Confidence level of the interval.
+    'mc_batch': 1024,  # Failure states sampled between precision checks.
+    'mc_max_samples': 1 << 20,  # Stop here even if short of the precision.
+    'mc_seed': 0,  # Base seed; each combo mixes in its own node indices.
+    'mc_bias': 1.0  # Failure probability multiplier for links on used paths.
+}
 PRINT_VERBOSE = True  # If true, print out metric details/sol'ns
 
 lg = logging.getLogger("metrics_lib")
@@ -106,7 +200,7 @@ def get_total_path_len_2(g, controllers, apsp, weighted = False):
         return get_total_path_len(g, controllers, apsp, weighted)
     else:
         closest_2 = closest_controllers_2(g, controllers, apsp)
-        return sum([apsp[n][c] for n, c in closest_2.iteritems()])
+        return sum([apsp[n][c] for n, c in closest_2.items()])
 
 
 def worst_case_latency(g, controllers, apsp, weighted = False):
@@ -309,6 +403,51 @@ def connectivity_sssp(g, combo, apsp, apsp_paths, weighted, failed_links):
     return connectivity
 
 
+def sssp_used_links(g, combo, apsp, apsp_paths):
+    '''Returns the union of the paths from each switch to its closest
+    controllers, as used by connectivity_sssp.
+
+    Links outside it are on no switch's path, so failing them leaves
+    connectivity at 1.0.
+
+    @return used: flattened NetworkX Graph of the paths
+    '''
+    paths = {}
+    for n in g.nodes():
+        closest_controller_dist = min([apsp[n][c] for c in combo])
+        for c in combo:
+            if apsp[n][c] == closest_controller_dist:
+                paths[(n, c)] = apsp_paths[n][c]
+    return flatten(paths)
+
+
+def link_fail_probs(g, weighted, link_fail_prob):
+    '''Returns the failure probability of each link, in g.edges() order.
+
+    @param link_fail_prob: see availability_one_combo
+    '''
+    if weighted:
+        return [link_fail_prob * g[src][dst]['weight'] for src, dst in g.edges()]
+    return [link_fail_prob] * g.number_of_edges()
+
+
+def failure_count_probs(fail_probs, max_failures):
+    '''Returns the probability that exactly f of some links fail, for each f.
+
+    Multiplies out prod((1 - p) + p * x) over the links, keeping the
+    coefficients of x^0 .. x^max_failures.
+
+    @param fail_probs: failure probability of each link
+    @return probs: list of max_failures + 1 probabilities
+    '''
+    probs = [1.0] + [0.0] * max_failures
+    for p in fail_probs:
+        for f in range(max_failures, 0, -1):
+            probs[f] = probs[f] * (1.0 - p) + probs[f - 1] * p
+        probs[0] *= (1.0 - p)
+    return probs
+
+
 def link_failure_combinations(g, failures):
     '''Returns combinations with the specified number of link failures.
     
@@ -323,8 +462,117 @@ def link_failure_combinations(g, failures):
         combos.append(c)
     return combos
 
+def link_failure_state_prob(g, failed_links, weighted, link_fail_prob):
+    '''Returns the probability of exactly this set of links being down.
+
+    @param g: NetworkX graph
+    @param failed_links: list of (src, dst) node pairs
+    @param weighted: is graph weighted?
+    @param link_fail_prob: see availability_one_combo
+    @return state_prob: probability of this failure state
+    '''
+    links = g.number_of_edges()
+    if weighted:
+        failed_links = set(failed_links)
+        state_prob = 1.0
+        for e in g.edges():
+            src, dst = e
+            weight = g[src][dst]['weight']
+            this_link_fail_prob = link_fail_prob * weight
+            if e in failed_links:
+                state_prob *= this_link_fail_prob
+            else:
+                state_prob *= (1.0 - this_link_fail_prob)
+    else:
+        bad_links = len(failed_links)
+        good_links = links - bad_links
+        link_success_prob = (1.0 - link_fail_prob) # 1-0.01=0.99
+        state_prob = ((link_success_prob ** good_links) *
+                      (link_fail_prob ** bad_links))
+    return state_prob
+
+
+def failure_depth(fail_probs, coverage_target, max_failures = None):
+    '''Returns the fewest simultaneous failures to enumerate for coverage.
+
+    Coverage depends only on the links' failure probabilities, not on the
+    combo, so one depth serves every combo of a topology.
+
+    @param fail_probs: failure probability of each link
+    @param coverage_target: probability mass the failure states should cover
+    @param max_failures: max depth to return, or None for no limit
+    @return depth: smallest number of failures whose states, together with
+        those of fewer failures, cover coverage_target; else max_failures
+    '''
+    if max_failures is None:
+        max_failures = len(fail_probs)
+    covered = 0.0
+    for failures, prob in enumerate(failure_count_probs(fail_probs,
+                                                        max_failures)):
+        covered += prob
+        if covered >= coverage_target:
+            return failures
+    return max_failures
+
+
+def availability_depth(g, weighted, extra_params):
+    '''Returns the max # simultaneous failures to simulate for extra_params.
+
+    @param extra_params: max_failures, coverage_target, or both; with a
+        coverage_target, see failure_depth, capped at any max_failures
+    '''
+    max_failures = extra_params.get('max_failures')
+    coverage_target = extra_params.get('coverage_target')
+    if coverage_target is None:
+        assert max_failures is not None
+        return max_failures
+    fail_probs = link_fail_probs(g, weighted, extra_params['link_fail_prob'])
+    return failure_depth(fail_probs, coverage_target, max_failures)
+
+
+def state_prob_terms(fail_probs):
+    '''Returns the terms that give state probabilities of failure sets.
+
+    A failure set's probability is the all-up probability times the odds
+    p / (1 - p) of each failed link, so only its failed links need a look.
+    Both terms are logs, so that long products don't underflow.
+
+    @param fail_probs: failure probability of each link
+    @return log_all_up: log probability that no link fails
+    @return log_odds: array of log odds of failure, per link
+    '''
+    fail_probs = numpy.asarray(fail_probs, dtype = float)
+    with numpy.errstate(divide = 'ignore'):
+        log_up = numpy.log1p(-fail_probs)
+        log_odds = numpy.log(fail_probs) - log_up
+    return log_up.sum(), log_odds
+
+
+def failure_state_probs(log_all_up, log_odds, failed):
+    '''Returns the state probability of each of a block of failure sets.
+
+    @param log_all_up, log_odds: see state_prob_terms
+    @param failed: (F x failures) array of failed link ids per failure set
+    @return state_probs: array of F state probabilities
+    '''
+    return numpy.exp(log_all_up + log_odds[failed].sum(axis = 1))
+
+
+def failure_set_blocks(num_links, failures):
+    '''Yields the failure sets of some links, as blocks of link ids.
+
+    @param num_links: number of links that may fail
+    @param failures: exact number of failed links
+    @return blocks: iterator of (B x failures) arrays, in the order of
+        link_failure_combinations
+    '''
+    if failures == 0:
+        return iter([numpy.zeros((1, 0), dtype = int)])
+    return combo_blocks(num_links, failures)
+
+
 def availability_one_combo(g, combo, apsp, apsp_paths, weighted,
-                           link_fail_prob, max_failures):
+                           link_fail_prob, max_failures, coverage_target = None):
     '''Compute connectivity for a single combination of controllers.
 
     @param g: NetworkX graph
@@ -337,42 +585,128 @@ def availability_one_combo(g, combo, apsp, apsp_paths, weighted,
             probability per unit weight that a given link will fail
         if weighted == False:
             probability that a given link will fail
-    @param max_failures: max # simultaneous failures to simulate
+    @param max_failures: max # simultaneous failures to simulate, or None
+        for no limit
+    @param coverage_target: if given, stop adding failures once the states
+        simulated cover this fraction of cases
     @return availability: average availability fraction
     @return coverage: fraction of cases considered.
     '''
-    availabilities = {}  # Probabilities * connectivity per # failures
-    coverages = {}  # Coverage per # failures
+    availabilities, coverages = availability_by_depth(g, combo, apsp,
+        apsp_paths, weighted, link_fail_prob, max_failures, coverage_target)
+    return sum(availabilities), sum(coverages)
+
+
+def availability_by_depth(g, combo, apsp, apsp_paths, weighted,
+                          link_fail_prob, max_failures, coverage_target = None):
+    '''Same as availability_one_combo, but broken down by # failures.
+
+    @return availabilities: list of availability from failure states with
+        exactly 0, 1, ... failures; summing the first f + 1 gives the
+        availability at max_failures = f
+    @return coverages: list of coverage, per # failures
+    '''
+    availabilities = []  # Probabilities * connectivity per # failures
+    coverages = []  # Coverage per # failures
     assert g
+    if max_failures is None:
+        max_failures = g.number_of_edges()
+
+    # Only failures of used links can change connectivity.  So enumerate
+    # just the sets of used links that fail; the unused links that fail
+    # alongside them come in as the combined probability that exactly so
+    # many unused links fail, with connectivity unchanged.
+    used = sssp_used_links(g, combo, apsp, apsp_paths)
+    fail_probs = link_fail_probs(g, weighted, link_fail_prob)
+    used_links = []
+    used_probs = []
+    unused_probs = []
+    for (src, dst), p in zip(g.edges(), fail_probs):
+        if used.has_edge(src, dst):
+            used_links.append((src, dst))
+            used_probs.append(p)
+        else:
+            unused_probs.append(p)
+    unused_count_probs = failure_count_probs(unused_probs, max_failures)
+    log_all_up, log_odds = state_prob_terms(used_probs)
 
     for failures in range(max_failures + 1):
-        availabilities[failures] = 0.0
-        coverages[failures] = 0.0
-        for failed_links in link_failure_combinations(g, failures):
-            links = g.number_of_edges()
-            if weighted:
-                state_prob = 1.0
-                for e in g.edges():
-                    src, dst = e
-                    weight = g[src][dst]['weight']
-                    this_link_fail_prob = link_fail_prob * weight
-                    if e in failed_links:
-                        state_prob *= this_link_fail_prob
-                    else:
-                        state_prob *= (1.0 - this_link_fail_prob)
-            else:
-                bad_links = len(failed_links)
-                good_links = links - bad_links
-                link_success_prob = (1.0 - link_fail_prob) # 1-0.01=0.99
-                state_prob = ((link_success_prob ** good_links) *
-                              (link_fail_prob ** bad_links))
-            
-            coverages[failures] += state_prob
-            conn = connectivity_sssp(g, combo, apsp, apsp_paths, weighted, failed_links)
-            availabilities[failures] += state_prob * conn
-
-    availability = sum(availabilities.values())
-    coverage = sum(coverages.values())
+        availabilities.append(0.0)
+        coverages.append(0.0)
+        for used_failures in range(min(failures, len(used_links)) + 1):
+            unused_prob = unused_count_probs[failures - used_failures]
+            for block in failure_set_blocks(len(used_links), used_failures):
+                state_probs = unused_prob * failure_state_probs(log_all_up,
+                    log_odds, block)
+                coverages[failures] += state_probs.sum()
+                if used_failures == 0:
+                    availabilities[failures] += state_probs.sum()
+                    continue
+                for failed, state_prob in zip(block, state_probs):
+                    failed_links = [used_links[i] for i in failed]
+                    conn = connectivity_sssp(g, combo, apsp, apsp_paths,
+                                             weighted, failed_links)
+                    availabilities[failures] += state_prob * conn
+        if coverage_target is not None and sum(coverages) >= coverage_target:
+            break
+    return availabilities, coverages
+
+
+def availability_polynomial(g, combo, apsp, apsp_paths, max_failures):
+    '''Compute the connectivity sums that make up unweighted availability.
+
+    With every link failing independently with probability p, availability
+    is sum_f sums[f] * p^f * (1 - p)^(E - f), a polynomial in p; evaluate it
+    for any p with polynomial_availability.
+
+    @param max_failures: max # simultaneous failures to simulate
+    @return sums: list where sums[f] is the total connectivity_sssp over
+        every set of f failed links
+    '''
+    used = sssp_used_links(g, combo, apsp, apsp_paths)
+    used_links = [(src, dst) for src, dst in g.edges()
+                  if used.has_edge(src, dst)]
+    unused = g.number_of_edges() - len(used_links)
+    sums = []
+    for failures in range(max_failures + 1):
+        total = 0.0
+        # As in availability_one_combo, enumerate only the failed used
+        # links; each pairs with every choice of failed unused links.
+        for used_failures in range(min(failures, len(used_links)) + 1):
+            unused_sets = choose(unused, failures - used_failures)
+            if unused_sets == 0:
+                continue
+            for failed_links in combinations(used_links, used_failures):
+                if used_failures == 0:
+                    conn = 1.0
+                else:
+                    conn = connectivity_sssp(g, combo, apsp, apsp_paths,
+                                             False, failed_links)
+                total += unused_sets * conn
+        sums.append(total)
+    return sums
+
+
+def polynomial_availability(sums, num_links, link_fail_prob):
+    '''Evaluate availability from availability_polynomial sums.
+
+    @param sums: connectivity sums per number of failures
+    @param num_links: number of links in the graph
+    @param link_fail_prob: probability that a given link will fail; a
+        number, or an array of them to evaluate at once
+    @return availability: same as availability_one_combo with
+        max_failures = len(sums) - 1, one per probability
+    @return coverage: fraction of cases considered, one per probability
+    '''
+    p = numpy.asarray(link_fail_prob, dtype = float)
+    availability = numpy.zeros(p.shape)
+    coverage = numpy.zeros(p.shape)
+    for failures, total in enumerate(sums):
+        state_prob = p ** failures * (1.0 - p) ** (num_links - failures)
+        availability += total * state_prob
+        coverage += choose(num_links, failures) * state_prob
+    if availability.ndim == 0:
+        return float(availability), float(coverage)
     return availability, coverage
 
 
@@ -399,11 +733,919 @@ def get_fairness(g, combo, apsp, apsp_paths, weighted, extra_params):
 
 def get_availability(g, combo, apsp, apsp_paths, weighted, extra_params):
     assert 'link_fail_prob' in extra_params
-    assert 'max_failures' in extra_params
+    assert 'max_failures' in extra_params or 'coverage_target' in extra_params
     availability, coverage = availability_one_combo(g, combo, apsp, apsp_paths,
-        weighted, extra_params['link_fail_prob'], extra_params['max_failures'])
+        weighted, extra_params['link_fail_prob'],
+        extra_params.get('max_failures'), extra_params.get('coverage_target'))
+    return availability
+
+
+def get_availability_depth(g, combo, apsp, apsp_paths, weighted, extra_params,
+                           failures):
+    '''Returns availability at max_failures = failures; see DEPTH_METRICS.
+
+    This per-combo reference sweeps the failure sets of each depth again;
+    with a DistanceMatrix, one pass serves every depth and every combo.
+    '''
+    assert 'link_fail_prob' in extra_params
+    availabilities, coverages = availability_by_depth(g, combo, apsp,
+        apsp_paths, weighted, extra_params['link_fail_prob'], failures)
+    return sum(availabilities)
+
+
+def sample_availability(incidence, shares, fail_probs, seed_key, extra_params):
+    '''Estimate availability by sampling link failure states.
+
+    Unlike availability_one_combo, every failure state counts, however many
+    links are down, so there is no coverage gap; instead, sampling stops
+    once the confidence interval is narrow enough.
+
+    With mc_bias > 1, links on the combo's paths fail more often in the
+    samples, and each sample's unavailability is reweighted by its
+    likelihood ratio, so that rare damaging states are seen sooner.
+
+    @param incidence: (P x E) boolean array: is link e on the path of
+        switch-controller pair p?
+    @param shares: length-P array: the fraction of its switch that each
+        pair connects, over the number of switches
+    @param fail_probs: failure probability of each link
+    @param seed_key: sequence of ints identifying the combo; with mc_seed, it
+        seeds the samples, so any worker gets the same estimate
+    @param extra_params: MC_DEFAULTS keys to override
+    @return availability: estimated availability
+    @return half_width: confidence interval half-width, at mc_confidence
+    @return samples: number of failure states sampled
+    '''
+    params = dict(MC_DEFAULTS)
+    params.update([(k, v) for k, v in extra_params.items() if k in MC_DEFAULTS])
+    rng = numpy.random.default_rng(numpy.random.SeedSequence(
+        params['mc_seed'], spawn_key = tuple([int(i) for i in seed_key])))
+
+    # Links on no path can't change connectivity; sample only the rest.
+    used = incidence.any(axis = 0)
+    incidence = incidence[:, used].T.astype(numpy.int32)  # (U x P)
+    probs = numpy.asarray(fail_probs, dtype = float)[used]
+    sample_probs = probs.copy()
+    biased = (probs > 0) & (probs < 0.5)
+    if params['mc_bias'] > 1:
+        sample_probs[biased] = numpy.minimum(probs[biased] * params['mc_bias'],
+                                             0.5)
+    biased &= sample_probs != probs
+    # Log likelihood ratio of a sample: log_down for each biased link that
+    # failed, log_up for each that didn't.
+    log_down = numpy.log(probs[biased] / sample_probs[biased])
+    log_up = numpy.log((1.0 - probs[biased]) / (1.0 - sample_probs[biased]))
+
+    z = NormalDist().inv_cdf(0.5 + params['mc_confidence'] / 2.0)
+    samples = 0
+    total = 0.0
+    total_sq = 0.0
+    while True:
+        failed = rng.random((params['mc_batch'], len(probs))) < sample_probs
+        cut = failed.astype(numpy.int32).dot(incidence) > 0  # (B x P)
+        loss = 1.0 - (~cut).dot(shares)
+        if biased.any():
+            down = failed[:, biased]
+            loss *= numpy.exp(down.dot(log_down) + (~down).dot(log_up))
+        samples += len(loss)
+        total += float(loss.sum())
+        total_sq += float((loss ** 2).sum())
+        mean = total / samples
+        if total > 0:
+            variance = max(total_sq / samples - mean ** 2, 0.0)
+            half_width = z * math.sqrt(variance / (samples - 1))
+        else:
+            # No failures seen: bound unavailability as the rule of three.
+            half_width = -math.log(1.0 - params['mc_confidence']) / samples
+        if (half_width <= params['mc_precision'] or
+            samples >= params['mc_max_samples']):
+            break
+    return 1.0 - mean, half_width, samples
+
+
+def availability_mc_one_combo(g, combo, apsp, apsp_paths, weighted,
+                              extra_params):
+    '''Sample availability for a single combination of controllers.
+
+    @param extra_params: link_fail_prob, plus any MC_DEFAULTS keys
+    @return same as sample_availability
+    '''
+    nodes = list(g.nodes())
+    index = dict((n, i) for i, n in enumerate(nodes))
+    edge_index = {}
+    for i, (src, dst) in enumerate(g.edges()):
+        edge_index[(src, dst)] = i
+        edge_index[(dst, src)] = i
+    rows = []
+    shares = []
+    for n in nodes:
+        closest_controller_dist = min([apsp[n][c] for c in combo])
+        closest = [c for c in combo if apsp[n][c] == closest_controller_dist]
+        for c in closest:
+            path = apsp_paths[n][c]
+            rows.append([edge_index[(path[i], path[i + 1])]
+                         for i in range(len(path) - 1)])
+            shares.append(1.0 / len(closest) / len(nodes))
+    incidence = numpy.zeros((len(rows), g.number_of_edges()), dtype = bool)
+    for i, row in enumerate(rows):
+        incidence[i, row] = True
+    fail_probs = link_fail_probs(g, weighted, extra_params['link_fail_prob'])
+    return sample_availability(incidence, numpy.array(shares), fail_probs,
+                               sorted([index[c] for c in combo]), extra_params)
+
+
+def get_availability_mc(g, combo, apsp, apsp_paths, weighted, extra_params):
+    assert 'link_fail_prob' in extra_params
+    availability, half_width, samples = availability_mc_one_combo(g, combo,
+        apsp, apsp_paths, weighted, extra_params)
     return availability
 
+
+class UnionFind(object):
+    '''Disjoint sets of node indices, whose unions can be rolled back.
+
+    Union by size, without path compression, so that each union changes
+    one parent pointer and undoing it is just as cheap.
+    '''
+
+    def __init__(self, num_nodes):
+        self.parent = list(range(num_nodes))
+        self.size = [1] * num_nodes
+        self.components = num_nodes
+        self.history = []  # Roots attached by each union, in order.
+
+    def find(self, i):
+        while self.parent[i] != i:
+            i = self.parent[i]
+        return i
+
+    def union(self, i, j):
+        i = self.find(i)
+        j = self.find(j)
+        if i == j:
+            return
+        if self.size[i] < self.size[j]:
+            i, j = j, i
+        self.parent[j] = i
+        self.size[i] += self.size[j]
+        self.components -= 1
+        self.history.append(j)
+
+    def mark(self):
+        '''Returns a point to roll back to.'''
+        return len(self.history)
+
+    def rollback(self, mark):
+        '''Undo every union since mark.'''
+        while len(self.history) > mark:
+            j = self.history.pop()
+            i = self.parent[j]
+            self.parent[j] = j
+            self.size[i] -= self.size[j]
+            self.components += 1
+
+    def labels(self):
+        '''Returns the root of each node's set.'''
+        return [self.find(i) for i in range(len(self.parent))]
+
+
+def reroute_components(edges, num_nodes, fail_probs, max_failures):
+    '''Returns the components left by every failure set, if rerouting.
+
+    Failure sets are visited depth-first, each one extending the last by one
+    link; the union-find holds the surviving links of lower id, so each
+    failure set adds only the links above its last failed one, and undoes
+    them after.  The sets that leave the graph connected are merged into
+    the first row.
+
+    @param edges: (src, dst) node index pairs, one per link
+    @param num_nodes: number of nodes
+    @param fail_probs: failure probability of each link
+    @param max_failures: max # simultaneous failures to simulate
+    @return labels: (S x n) array; labels[s, i] is the component of node i
+        under failure state s
+    @return state_probs: array of S state probabilities
+    '''
+    log_all_up, log_odds = state_prob_terms(fail_probs)
+    uf = UnionFind(num_nodes)
+    labels = [[0] * num_nodes]
+    state_probs = [0.0]
+
+    def visit(failed, lo):
+        # uf holds every link below lo that isn't in failed.
+        for e in range(lo, len(edges)):
+            if len(failed) < max_failures:
+                mark = uf.mark()
+                visit(failed + [e], e + 1)
+                uf.rollback(mark)
+            uf.union(*edges[e])
+        state_prob = math.exp(log_all_up + sum(log_odds[failed]))
+        if uf.components == 1:
+            state_probs[0] += state_prob
+        else:
+            labels.append(uf.labels())
+            state_probs.append(state_prob)
+
+    visit([], 0)
+    return numpy.array(labels, dtype = numpy.int32), numpy.array(state_probs)
+
+
+def reroute_availability(labels, state_probs, combo_index):
+    '''Returns the availability of a combo when switches may reroute.
+
+    A switch is connected under a failure state when its component holds
+    any controller.
+
+    @param labels, state_probs: see reroute_components
+    @param combo_index: array of controller node indices
+    '''
+    rows = numpy.arange(len(labels))[:, numpy.newaxis]
+    has_controller = numpy.zeros(labels.shape, dtype = bool)
+    has_controller[rows, labels[:, combo_index]] = True
+    return float(state_probs.dot(has_controller[rows, labels].mean(axis = 1)))
+
+
+def get_availability_reroute(g, combo, apsp, apsp_paths, weighted,
+                             extra_params):
+    assert 'link_fail_prob' in extra_params
+    index = dict((n, i) for i, n in enumerate(g.nodes()))
+    edges = [(index[src], index[dst]) for src, dst in g.edges()]
+    labels, state_probs = reroute_components(edges, len(index),
+        link_fail_probs(g, weighted, extra_params['link_fail_prob']),
+        availability_depth(g, weighted, extra_params))
+    combo_index = numpy.array([index[c] for c in combo], dtype = int)
+    return reroute_availability(labels, state_probs, combo_index)
+
+
+class DistanceMatrix(object):
+    '''Dense, node-indexed all-pairs shortest path lengths for one topology.
+
+    Built once per topology, so that the assignment of switches to
+    controllers becomes a min/argmin over the combo's columns, rather than a
+    walk over dict-of-dicts APSP data for every node and controller.
+    '''
+
+    def __init__(self, g, apsp, apsp_paths = None):
+        '''
+        @param g: NetworkX graph
+        @param apsp: all-pairs shortest paths data
+        @param apsp_paths: all-pairs shortest paths path data; only needed
+            for metrics that follow paths (congestion, availability).
+        '''
+        self.nodes = list(g.nodes())
+        self.index = dict((n, i) for i, n in enumerate(self.nodes))
+        self.dist = numpy.array([[apsp[a][b] for b in self.nodes]
+                                 for a in self.nodes], dtype = float)
+
+        # Integer ids for each edge, in either direction.
+        self.edges = list(g.edges())
+        self.edge_index = {}
+        for i, (src, dst) in enumerate(self.edges):
+            self.edge_index[(src, dst)] = i
+            self.edge_index[(dst, src)] = i
+
+        # Edge ids on every shortest path, concatenated in (i, j) order;
+        # path(i, j) slices out the ids on the path from node i to node j.
+        self.path_edge_ids = None
+        self.path_offsets = None
+        if apsp_paths is not None:
+            edge_ids = []
+            lengths = []
+            for a in self.nodes:
+                for b in self.nodes:
+                    path = apsp_paths[a][b]
+                    edge_ids += [self.edge_index[(path[i], path[i + 1])]
+                                 for i in range(len(path) - 1)]
+                    lengths.append(len(path) - 1)
+            self.path_edge_ids = numpy.array(edge_ids, dtype = numpy.int32)
+            self.path_offsets = numpy.zeros(len(lengths) + 1, dtype = numpy.int64)
+            self.path_offsets[1:] = numpy.cumsum(lengths)
+
+        # Optional (n x n) availability of each path, over all failure sets;
+        # see AvailabilityEngine.path_availability.
+        self.path_availability = None
+        # Optional (depths x n x n) path availability per max # failures;
+        # see AvailabilityEngine.depth_availability.
+        self.depth_availability = None
+        # Optional failure states for rerouting; see reroute_components.
+        self.reroute_labels = None
+        self.reroute_probs = None
+
+        # SharedMemory blocks backing the arrays, if shared or attached.
+        self.shared_blocks = []
+
+        # Most recent Assignment, shared by all metrics for the same combo.
+        self.assignment = None
+
+        # AvailabilityEngine for the last failure model asked for.
+        self.engine = None
+
+    # Arrays that share() publishes and attach() maps back in.
+    SHARED_ARRAYS = ['dist', 'path_edge_ids', 'path_offsets',
+                     'path_availability', 'depth_availability',
+                     'reroute_labels', 'reroute_probs']
+
+    def share(self):
+        '''Move the arrays into shared memory, for workers to attach to.
+
+        @return spec: small picklable description to pass to attach()
+        '''
+        spec = {'nodes': self.nodes, 'edges': self.edges, 'arrays': {}}
+        for name in self.SHARED_ARRAYS:
+            array = getattr(self, name)
+            if array is None:
+                continue
+            block = shared_memory.SharedMemory(create = True,
+                                               size = max(array.nbytes, 1))
+            shared = numpy.ndarray(array.shape, dtype = array.dtype,
+                                   buffer = block.buf)
+            shared[...] = array
+            setattr(self, name, shared)
+            self.shared_blocks.append(block)
+            spec['arrays'][name] = (block.name, array.shape, array.dtype.str)
+        return spec
+
+    @classmethod
+    def attach(cls, spec):
+        '''Returns a DistanceMatrix viewing the shared arrays of spec, zero-copy.
+
+        @param spec: description returned by share()
+        '''
+        dm = cls.__new__(cls)
+        dm.nodes = spec['nodes']
+        dm.index = dict((n, i) for i, n in enumerate(dm.nodes))
+        dm.edges = spec['edges']
+        dm.edge_index = {}
+        for i, (src, dst) in enumerate(dm.edges):
+            dm.edge_index[(src, dst)] = i
+            dm.edge_index[(dst, src)] = i
+        blocks = []
+        for name in cls.SHARED_ARRAYS:
+            setattr(dm, name, None)
+            if name in spec['arrays']:
+                block_name, shape, dtype = spec['arrays'][name]
+                block = shared_memory.SharedMemory(name = block_name)
+                setattr(dm, name, numpy.ndarray(shape, dtype = dtype,
+                                                buffer = block.buf))
+                blocks.append(block)
+        # Set after the arrays, so that when dm is freed, the arrays viewing
+        # each block are released before the block is closed.
+        dm.shared_blocks = blocks
+        dm.assignment = None
+        dm.engine = None
+        return dm
+
+    def unlink(self):
+        '''Copy the arrays back to private memory and free the shared blocks.'''
+        for name in self.SHARED_ARRAYS:
+            array = getattr(self, name)
+            if array is not None:
+                setattr(self, name, numpy.array(array))
+        for block in self.shared_blocks:
+            block.close()
+            block.unlink()
+        self.shared_blocks = []
+
+    def path(self, i, j):
+        '''Returns the array of edge ids on the path from node i to node j.'''
+        k = i * len(self.nodes) + j
+        return self.path_edge_ids[self.path_offsets[k]:self.path_offsets[k + 1]]
+
+    def combo_index(self, combo):
+        '''Returns an array of matrix indices for a list of nodes.'''
+        return numpy.array([self.index[c] for c in combo], dtype = int)
+
+    def columns(self, combo):
+        '''Returns the (n x k) distances from every node to each controller.'''
+        return self.dist[:, self.combo_index(combo)]
+
+    def assign(self, combo):
+        '''Returns the Assignment for combo, reusing the last one if unchanged.'''
+        if self.assignment is None or self.assignment.combo != tuple(combo):
+            self.assignment = Assignment(self, combo)
+        return self.assignment
+
+    def availability_engine(self, g, weighted, link_fail_prob):
+        '''Returns the AvailabilityEngine for a failure model, reusing the last
+        one if unchanged.'''
+        if (self.engine is None or
+            (self.engine.weighted, self.engine.link_fail_prob) !=
+            (weighted, link_fail_prob)):
+            self.engine = AvailabilityEngine(g, self, weighted, link_fail_prob)
+        return self.engine
+
+
+class Assignment(object):
+    '''Nearest-controller assignment of every switch for a single combo.
+
+    Computed once per combo and shared by every metric, so that adding a
+    metric doesn't add another pass over the combo's columns.
+
+    @attr combo_index: matrix indices of the controllers
+    @attr nearest: distance from each node to its closest controller
+    @attr second: distance from each node to its second-closest controller;
+        same as nearest when there is only one controller
+    @attr ties: boolean (n x k) mask of each node's equally-closest controllers
+    @attr share: fraction of each node assigned to each of its tied controllers
+    '''
+
+    def __init__(self, dm, combo):
+        self.combo = tuple(combo)
+        self.combo_index = dm.combo_index(combo)
+        cols = dm.dist[:, self.combo_index]
+        self.nearest = cols.min(axis = 1)
+        if len(combo) > 1:
+            self.second = numpy.partition(cols, 1, axis = 1)[:, 1]
+        else:
+            self.second = self.nearest
+        self.ties = cols == self.nearest[:, numpy.newaxis]
+        self.share = 1.0 / self.ties.sum(axis = 1)
+
+    def tied_pairs(self):
+        '''Yields (node index, controller index) for each closest pair.'''
+        for n, c in zip(*numpy.nonzero(self.ties)):
+            yield n, self.combo_index[c]
+
+
+class AvailabilityEngine(object):
+    '''Availability under link failures, over bitmasks of edge ids.
+
+    Every shortest path is a bitmask over edge ids, as is every failure set;
+    a path survives a failure set when the two masks share no bits.  None of
+    that depends on the combo, so path_availability() folds every failure
+    set into one (n x n) table of probability-weighted survival per path,
+    built once; each combo is then a lookup and weighted sum over its
+    switch-controller pairs.
+    '''
+
+    def __init__(self, g, dm, weighted, link_fail_prob):
+        '''
+        @param g: NetworkX graph
+        @param dm: DistanceMatrix, with paths
+        @param weighted: is graph weighted?
+        @param link_fail_prob: see availability_one_combo
+        '''
+        self.g = g
+        self.dm = dm
+        self.weighted = weighted
+        self.link_fail_prob = link_fail_prob
+        num_edges = len(dm.edges)
+        self.words = max(1, (num_edges + 63) // 64)  # uint64 words per mask
+        edge_ids = numpy.arange(num_edges)
+        self.edge_words = edge_ids // 64
+        self.edge_bits = numpy.left_shift(numpy.uint64(1),
+                                          (edge_ids % 64).astype(numpy.uint64))
+
+        # Mask of each (i, j) path, in the row order of dm.path_offsets.
+        num_paths = len(dm.path_offsets) - 1
+        path_ids = numpy.repeat(numpy.arange(num_paths),
+                                numpy.diff(dm.path_offsets))
+        self.path_masks = numpy.zeros((num_paths, self.words),
+                                      dtype = numpy.uint64)
+        numpy.bitwise_or.at(self.path_masks,
+                            (path_ids, self.edge_words[dm.path_edge_ids]),
+                            self.edge_bits[dm.path_edge_ids])
+
+        self.fail_probs = link_fail_probs(g, weighted, link_fail_prob)
+        self.log_all_up, self.log_odds = state_prob_terms(self.fail_probs)
+        self.failure_tables = {}  # failures: (masks, state probabilities)
+        self.depth_tables = None  # Path availability tables per depth.
+        self.reroute_tables = {}  # max_failures: (labels, state probabilities)
+        self.survivor_tables = {}  # failures: path survivor counts
+
+    def failure_sets(self, failures):
+        '''Returns the masks and state probabilities of every failure set.
+
+        @param failures: exact number of failed links
+        @return masks: (F x words) array, one row per failure set, in the
+            order of link_failure_combinations
+        @return state_probs: array of F failure state probabilities
+        '''
+        if failures not in self.failure_tables:
+            masks = []
+            state_probs = []
+            for combos in failure_set_blocks(len(self.dm.edges), failures):
+                block_masks = numpy.zeros((len(combos), self.words),
+                                          dtype = numpy.uint64)
+                rows = numpy.arange(len(combos))
+                for j in range(failures):
+                    block_masks[rows, self.edge_words[combos[:, j]]] |= \
+                        self.edge_bits[combos[:, j]]
+                masks.append(block_masks)
+                state_probs.append(failure_state_probs(self.log_all_up,
+                                                       self.log_odds, combos))
+            self.failure_tables[failures] = (numpy.concatenate(masks),
+                                             numpy.concatenate(state_probs))
+        return self.failure_tables[failures]
+
+    def path_availability(self, max_failures):
+        '''Returns the availability of every path, over all failure sets.
+
+        @param max_failures: max # simultaneous failures to simulate
+        @return table: (n x n) array; entry (i, j) sums the state probability
+            of each failure set that leaves the path from i to j intact
+        '''
+        return self.depth_availability(max_failures)[max_failures]
+
+    def depth_availability(self, max_failures):
+        '''Returns path_availability at every depth up to max_failures.
+
+        Each depth adds the failure sets of one more failure to the one
+        before, so all of them take a single pass.
+
+        @param max_failures: max # simultaneous failures to simulate
+        @return tables: (max_failures + 1) x n x n array; tables[f] is
+            path_availability(f)
+        '''
+        if self.depth_tables is None or len(self.depth_tables) <= max_failures:
+            num_nodes = len(self.dm.nodes)
+            table = numpy.zeros(len(self.path_masks))
+            tables = []
+            for failures in range(max_failures + 1):
+                state_probs = self.failure_sets(failures)[1]
+                for lo, hi, cut in self.cut_blocks(failures):
+                    table += state_probs[lo:hi].dot(~cut)
+                tables.append(table.reshape(num_nodes, num_nodes).copy())
+            self.depth_tables = numpy.array(tables)
+        return self.depth_tables[:max_failures + 1]
+
+    def path_survivors(self, failures):
+        '''Returns how many failure sets of one size leave each path intact.
+
+        Unlike path_availability, the counts don't depend on link failure
+        probabilities.
+
+        @param failures: exact number of failed links
+        @return table: (n x n) array of counts
+        '''
+        if failures not in self.survivor_tables:
+            table = numpy.zeros(len(self.path_masks))
+            for lo, hi, cut in self.cut_blocks(failures):
+                table += (~cut).sum(axis = 0)
+            num_nodes = len(self.dm.nodes)
+            self.survivor_tables[failures] = table.reshape(num_nodes, num_nodes)
+        return self.survivor_tables[failures]
+
+    def cut_blocks(self, failures):
+        '''Yields (lo, hi, cut) for each block of failure sets of one size,
+        where cut is an (F x paths) boolean array: does failure set lo + i cut
+        path j?'''
+        fail_masks = self.failure_sets(failures)[0]
+        for lo in range(0, len(fail_masks), BATCH_SIZE):
+            hi = lo + BATCH_SIZE
+            cut = numpy.zeros((len(fail_masks[lo:hi]), len(self.path_masks)),
+                              dtype = bool)
+            for w in range(self.words):
+                cut |= (fail_masks[lo:hi, w, numpy.newaxis] &
+                        self.path_masks[numpy.newaxis, :, w]) != 0
+            yield lo, hi, cut
+
+    def polynomial(self, assignment, max_failures):
+        '''Returns a combo's connectivity sums per failure count; see
+        availability_polynomial.'''
+        return [assignment_availability(assignment, self.path_survivors(f))
+                for f in range(max_failures + 1)]
+
+    def reroute_table(self, max_failures):
+        '''Returns the components under each failure state; see
+        reroute_components.'''
+        if max_failures not in self.reroute_tables:
+            edges = [(self.dm.index[src], self.dm.index[dst])
+                     for src, dst in self.dm.edges]
+            self.reroute_tables[max_failures] = reroute_components(edges,
+                len(self.dm.nodes), self.fail_probs, max_failures)
+        return self.reroute_tables[max_failures]
+
+    def availability(self, assignment, max_failures):
+        '''Returns the availability of a combo; see availability_one_combo.
+
+        @param assignment: Assignment for the combo
+        @param max_failures: max # simultaneous failures to simulate
+        '''
+        return assignment_availability(assignment,
+                                       self.path_availability(max_failures))
+
+
+def assignment_availability(assignment, table):
+    '''Returns the availability of a combo from a path availability table.
+
+    Each switch counts the availability of the path to each of its equally
+    close controllers, by its share of that controller.
+    '''
+    nodes, cols = numpy.nonzero(assignment.ties)
+    values = table[nodes, assignment.combo_index[cols]]
+    return float((assignment.share[nodes] * values).sum()) / len(table)
+
+
+def get_latency_matrix(g, combo, dm, apsp_paths, weighted, extra_params):
+    return float(dm.assign(combo).nearest.mean())
+
+def get_latency_2_matrix(g, combo, dm, apsp_paths, weighted, extra_params):
+    return float(dm.assign(combo).second.mean())
+
+def get_wc_latency_matrix(g, combo, dm, apsp_paths, weighted, extra_params):
+    return float(dm.assign(combo).nearest.max())
+
+def get_wc_latency_2_matrix(g, combo, dm, apsp_paths, weighted, extra_params):
+    return float(dm.assign(combo).second.max())
+
+def get_fairness_matrix(g, combo, dm, apsp_paths, weighted, extra_params):
+    assignment = dm.assign(combo)
+    # For switches equally distant from n controllers, split share equally.
+    allocations = (assignment.ties *
+                   assignment.share[:, numpy.newaxis]).sum(axis = 0)
+    return float(fairness(allocations[allocations > 0]))
+
+def get_congestion_matrix(g, combo, dm, apsp_paths, weighted, extra_params = None):
+    assignment = dm.assign(combo)
+    traffic = numpy.zeros(len(dm.edges))
+    for n, c in assignment.tied_pairs():
+        traffic[dm.path(n, c)] += assignment.share[n]
+    return float(traffic.max()) / len(dm.nodes)
+
+def get_availability_matrix(g, combo, dm, apsp_paths, weighted, extra_params):
+    table = dm.path_availability
+    if table is None:
+        assert 'link_fail_prob' in extra_params
+        engine = dm.availability_engine(g, weighted,
+                                        extra_params['link_fail_prob'])
+        table = engine.path_availability(availability_depth(g, weighted,
+                                                            extra_params))
+    return assignment_availability(dm.assign(combo), table)
+
+
+def get_availability_depth_matrix(g, combo, dm, apsp_paths, weighted,
+                                  extra_params, failures):
+    tables = dm.depth_availability
+    if tables is None or len(tables) <= failures:
+        assert 'link_fail_prob' in extra_params
+        engine = dm.availability_engine(g, weighted,
+                                        extra_params['link_fail_prob'])
+        tables = engine.depth_availability(failures)
+    return assignment_availability(dm.assign(combo), tables[failures])
+
+
+def get_availability_reroute_matrix(g, combo, dm, apsp_paths, weighted,
+                                    extra_params):
+    labels, state_probs = dm.reroute_labels, dm.reroute_probs
+    if labels is None:
+        assert 'link_fail_prob' in extra_params
+        engine = dm.availability_engine(g, weighted,
+                                        extra_params['link_fail_prob'])
+        labels, state_probs = engine.reroute_table(availability_depth(g,
+            weighted, extra_params))
+    return reroute_availability(labels, state_probs, dm.combo_index(combo))
+
+
+def get_availability_mc_matrix(g, combo, dm, apsp_paths, weighted, extra_params):
+    assert 'link_fail_prob' in extra_params
+    assignment = dm.assign(combo)
+    nodes, cols = numpy.nonzero(assignment.ties)
+    incidence = numpy.zeros((len(nodes), len(dm.edges)), dtype = bool)
+    for i, (n, c) in enumerate(zip(nodes, assignment.combo_index[cols])):
+        incidence[i, dm.path(n, c)] = True
+    shares = assignment.share[nodes] / len(dm.nodes)
+    fail_probs = link_fail_probs(g, weighted, extra_params['link_fail_prob'])
+    availability, half_width, samples = sample_availability(incidence, shares,
+        fail_probs, sorted(assignment.combo_index), extra_params)
+    return availability
+
+
+def batch_metrics(dm, combos, metrics):
+    '''Compute metrics for a block of combos with one gather-and-reduce.
+
+    @param dm: DistanceMatrix
+    @param combos: (B x k) integer array of node indices, one combo per row
+    @param metrics: metrics to compute, all in BATCH_METRICS
+    @return values: dict of metric to (array of B values, duration) tuples
+    '''
+    values = {}
+    start_time = time.time()
+    # Running (B x n) nearest and second-nearest distances, folding in one
+    # controller column at a time; much faster than reducing over a
+    # (B x k x n) gather.
+    dist_t = dm.dist.T
+    nearest = dist_t[combos[:, 0]]
+    second = nearest
+    for j in range(1, combos.shape[1]):
+        col = dist_t[combos[:, j]]
+        if j == 1:
+            second = numpy.maximum(nearest, col)
+        else:
+            second = numpy.minimum(second, numpy.maximum(nearest, col))
+        nearest = numpy.minimum(nearest, col)
+    duration = time.time() - start_time
+
+    for metric in metrics:
+        start_time = time.time()
+        if metric == 'null':
+            metric_values = numpy.zeros(len(combos))
+        elif metric == 'latency':
+            metric_values = nearest.mean(axis = 1)
+        elif metric == 'wc_latency':
+            metric_values = nearest.max(axis = 1)
+        elif metric == 'latency_2':
+            metric_values = second.mean(axis = 1)
+        elif metric == 'wc_latency_2':
+            metric_values = second.max(axis = 1)
+        elif metric == 'fairness':
+            ties = dist_t[combos] == nearest[:, numpy.newaxis, :]
+            allocations = (ties / ties.sum(axis = 1, keepdims = True)).sum(axis = 2)
+            metric_values = (allocations.sum(axis = 1) ** 2 /
+                             (numpy.count_nonzero(allocations, axis = 1) *
+                              (allocations ** 2).sum(axis = 1)))
+        elif metric == 'availability' or metric in DEPTH_METRICS:
+            if metric == 'availability':
+                table = dm.path_availability
+            elif dm.depth_availability is not None:
+                table = dm.depth_availability[metric_depth(metric)]
+            else:
+                table = None
+            if table is None:
+                raise Exception("%s in batches needs path availability" % metric)
+            ties = dist_t[combos] == nearest[:, numpy.newaxis, :]
+            # (B x k x n) availability of each switch's path to each controller
+            paths = table.T[combos]
+            metric_values = ((ties * paths).sum(axis = 1) /
+                             ties.sum(axis = 1)).mean(axis = 1)
+        else:
+            raise Exception("metric not supported in batches: %s" % metric)
+        values[metric] = (metric_values, duration + time.time() - start_time)
+    return values
+
+# Metrics that batch_metrics can compute; availability needs the
+# DistanceMatrix's path_availability table, and DEPTH_METRICS its
+# depth_availability tables.
+BATCH_METRICS = ['null', 'latency', 'wc_latency', 'latency_2', 'wc_latency_2',
+                 'fairness', 'availability'] + DEPTH_METRICS
+
+
+def combo_blocks(num_nodes, combo_size, block_size = BATCH_SIZE, lo = 0,
+                 hi = None):
+    '''Yield itertools.combinations of node indices in fixed-size blocks.
+
+    @param num_nodes: number of nodes
+    @param combo_size: number of controllers per combo
+    @param block_size: max combos per block
+    @param lo: rank of the first combo to yield
+    @param hi: rank one past the last combo to yield; None for all
+    @return blocks: iterator of (B x combo_size) integer arrays
+    '''
+    if hi is None:
+        hi = choose(num_nodes, combo_size)
+    if lo == 0 and hi == choose(num_nodes, combo_size):
+        all_combos = combinations(range(num_nodes), combo_size)
+    else:
+        all_combos = combinations_range(num_nodes, combo_size, lo, hi)
+    while True:
+        block = numpy.fromiter(chain.from_iterable(islice(all_combos, block_size)),
+                               dtype = int)
+        if len(block) == 0:
+            return
+        yield block.reshape(-1, combo_size)
+
+
+def combination_ranks(combos, num_nodes):
+    '''Returns the lexicographic rank of each row of a (B x k) index array.
+
+    Vectorized itertools_recipes.combination_rank, using
+    rank = choose(n, k) - 1 - sum_i choose(n - 1 - combo[i], k - i).
+    '''
+    combo_size = combos.shape[1]
+    table = numpy.array([[choose(a, b) for b in range(combo_size + 1)]
+                         for a in range(num_nodes + 1)], dtype = numpy.int64)
+    ranks = numpy.full(len(combos), choose(num_nodes, combo_size) - 1,
+                       dtype = numpy.int64)
+    for i in range(combo_size):
+        ranks -= table[num_nodes - 1 - combos[:, i], combo_size - i]
+    return ranks
+
+
+# Metrics that revolving_door_blocks can update incrementally.
+INCREMENTAL_METRICS = ['null', 'latency', 'wc_latency', 'latency_2',
+                       'wc_latency_2']
+
+# Orders in which run_all_combos can enumerate combinations.
+ENUMERATIONS = ['lexicographic', 'revolving_door']
+
+
+def nearest_two(dist_t, combo, rows = slice(None)):
+    '''Returns the two closest controllers for some rows of the matrix.
+
+    @param dist_t: transposed distance matrix (controller x node)
+    @param combo: array of controller indices
+    @param rows: node indices (or slice) to compute for
+    @return d1, a1, d2, a2: distance to and index of the closest and
+        second-closest controllers for each row; with fewer than two
+        controllers, missing distances are inf and missing indices -1.
+    '''
+    cols = dist_t[combo][:, rows]
+    num_rows = cols.shape[1]
+    d1 = numpy.full(num_rows, numpy.inf)
+    d2 = numpy.full(num_rows, numpy.inf)
+    a1 = numpy.full(num_rows, -1)
+    a2 = numpy.full(num_rows, -1)
+    order = numpy.argsort(cols, axis = 0, kind = 'stable')
+    positions = numpy.arange(num_rows)
+    if len(combo) > 0:
+        d1, a1 = cols[order[0], positions], combo[order[0]]
+    if len(combo) > 1:
+        d2, a2 = cols[order[1], positions], combo[order[1]]
+    return d1, a1, d2, a2
+
+
+def revolving_door_blocks(dm, combo_size, metrics, block_size = BATCH_SIZE):
+    '''Enumerate combos in revolving-door order, updating state incrementally.
+
+    Consecutive combos differ by one swapped controller.  The order is made
+    of runs in which only the lowest controller moves; each switch's nearest
+    and second-nearest distance to the rest of the combo is updated in O(n)
+    when the rest changes (by one swap), recomputing only switches that lose
+    one of their two closest controllers.  Each run is then scored as one
+    vectorized min over the moving controller's rows.
+
+    @param dm: DistanceMatrix
+    @param combo_size: number of controllers per combo
+    @param metrics: metrics to compute, all in INCREMENTAL_METRICS
+    @param block_size: yield blocks once they reach this many combos
+    @return blocks: iterator of (combos, values) pairs, with combos a (B x k)
+        integer array and values in the same format as batch_metrics.
+    '''
+    for metric in metrics:
+        if metric not in INCREMENTAL_METRICS:
+            raise Exception("metric not supported incrementally: %s" % metric)
+    dist_t = dm.dist.T
+    n = len(dm.nodes)
+    combo_runs = []
+    value_runs = dict((m, []) for m in metrics)
+    num = 0
+    start_time = time.time()
+    prev = None
+    for rest, run in groupby(revolving_door_combinations(n, combo_size),
+                             key = lambda c: c[1:]):
+        rest_combo = numpy.array(rest, dtype = int)
+        lowest = numpy.array([c[0] for c in run], dtype = int)
+        # Update nearest two controllers among the rest of the combo.
+        swapped_out = prev is not None and set(prev) - set(rest)
+        if not swapped_out or len(swapped_out) != 1:
+            d1, a1, d2, a2 = nearest_two(dist_t, rest_combo)
+        else:
+            out = swapped_out.pop()
+            new = (set(rest) - set(prev)).pop()
+            stale = numpy.nonzero((a1 == out) | (a2 == out))[0]
+            col = dist_t[new]
+            closer = col < d1
+            second_closer = ~closer & (col < d2)
+            d2 = numpy.where(closer, d1, numpy.where(second_closer, col, d2))
+            a2 = numpy.where(closer, a1, numpy.where(second_closer, new, a2))
+            d1 = numpy.where(closer, col, d1)
+            a1 = numpy.where(closer, new, a1)
+            if len(stale):
+                d1[stale], a1[stale], d2[stale], a2[stale] = \
+                    nearest_two(dist_t, rest_combo, stale)
+        prev = rest
+
+        # Fold in the lowest controller for every combo in the run.
+        cols = dist_t[lowest]
+        nearest = numpy.minimum(d1, cols)
+        if combo_size > 1:
+            second = numpy.minimum(d2, numpy.maximum(d1, cols))
+        else:
+            second = nearest
+        for metric in metrics:
+            if metric == 'null':
+                run_values = numpy.zeros(len(lowest))
+            elif metric == 'latency':
+                run_values = nearest.mean(axis = 1)
+            elif metric == 'wc_latency':
+                run_values = nearest.max(axis = 1)
+            elif metric == 'latency_2':
+                run_values = second.mean(axis = 1)
+            elif metric == 'wc_latency_2':
+                run_values = second.max(axis = 1)
+            value_runs[metric].append(run_values)
+        combos = numpy.empty((len(lowest), combo_size), dtype = int)
+        combos[:, 0] = lowest
+        combos[:, 1:] = rest_combo
+        combo_runs.append(combos)
+        num += len(lowest)
+
+        if num >= block_size:
+            duration = (time.time() - start_time) / len(metrics)
+            yield (numpy.concatenate(combo_runs),
+                   dict((m, (numpy.concatenate(value_runs[m]), duration))
+                        for m in metrics))
+            combo_runs = []
+            value_runs = dict((m, []) for m in metrics)
+            num = 0
+            start_time = time.time()
+    if num:
+        duration = (time.time() - start_time) / len(metrics)
+        yield (numpy.concatenate(combo_runs),
+               dict((m, (numpy.concatenate(value_runs[m]), duration))
+                    for m in metrics))
+
+
 # Map of metric names to functions to execute them.
 # Functions must have these parameters:
 # (g, combo, apsp, apsp_paths, weighted, extra_params)
@@ -415,11 +1657,41 @@ METRIC_FCNS = {
     'fairness': get_fairness,
     'congestion': control_traffic_congestion,
     'availability': get_availability,
+    'availability_mc': get_availability_mc,
+    'availability_reroute': get_availability_reroute,
     'wc_latency_2': get_wc_latency_2
 }
 
+# Same as METRIC_FCNS, but with a DistanceMatrix in place of apsp:
+# (g, combo, dm, apsp_paths, weighted, extra_params)
+METRIC_FCNS_MATRIX = {
+    'null': get_null,
+    'latency': get_latency_matrix,
+    'latency_2': get_latency_2_matrix,
+    'wc_latency': get_wc_latency_matrix,
+    'fairness': get_fairness_matrix,
+    'congestion': get_congestion_matrix,
+    'availability': get_availability_matrix,
+    'availability_mc': get_availability_mc_matrix,
+    'availability_reroute': get_availability_reroute_matrix,
+    'wc_latency_2': get_wc_latency_2_matrix
+}
+
+for failures in range(1, MAX_DEPTH_METRIC + 1):
+    METRIC_FCNS[depth_metric(failures)] = partial(get_availability_depth,
+                                                  failures = failures)
+    METRIC_FCNS_MATRIX[depth_metric(failures)] = partial(
+        get_availability_depth_matrix, failures = failures)
+
 METRICS = METRIC_FCNS.keys()
 
+
+def get_metric_fcns(apsp):
+    '''Returns the map of metric functions that accept this apsp data.'''
+    if isinstance(apsp, DistanceMatrix):
+        return METRIC_FCNS_MATRIX
+    return METRIC_FCNS
+
 # Return long name, suitable for printing
 def metric_fullname(metric):
     if metric == 'latency':
@@ -445,14 +1717,16 @@ def handle_combo(combo):
     values = {}
     for metric in g_metrics:
         start_time = time.time()
-        metric_value = METRIC_FCNS[metric](g_g, combo, g_apsp, g_apsp_paths,
-                                           g_weighted, g_extra_params)
+        metric_value = get_metric_fcns(g_apsp)[metric](g_g, combo, g_apsp,
+            g_apsp_paths, g_weighted, g_extra_params)
         duration = time.time() - start_time
         values[metric] = (metric_value, duration)
     return [combo, values]
 
 
-def process_result(metrics, median, write_combos, write_dist, combo, values, point_id, distribution, metric_data):
+def process_result(metrics, median, write_combos, write_dist, combo, values, point_id, distribution, metric_data, combo_format = 'names'):
+    if combo_format == 'rank':
+        combo = encode_combo(combo)
     json_entry = {}  # For writing to distribution
     json_entry['id'] = point_id
     point_id += 1
@@ -468,7 +1742,7 @@ def process_result(metrics, median, write_combos, write_dist, combo, values, poi
             this_metric['highest'] = metric_value
             this_metric['highest_combo'] = combo
         if median:
-            this_metric['values'].append(metric_value)
+            this_metric['sketch'].add(metric_value)
         this_metric['sum'] += metric_value
         this_metric['num'] += 1
 
@@ -478,7 +1752,84 @@ def process_result(metrics, median, write_combos, write_dist, combo, values, poi
         json_entry['combo'] = combo
 
     if write_dist:
-        distribution.append(json_entry)
+        if is_histogram(distribution):
+            for metric in metrics:
+                add_to_histogram(distribution[metric], [values[metric][0]])
+        elif is_columnar(distribution):
+            distribution.add([json_entry['id']],
+                dict((metric, [values[metric][0]]) for metric in metrics))
+        else:
+            distribution.append(json_entry)
+
+
+def process_batch_result(metrics, median, write_combos, write_dist, nodes, combos, values, point_id, distribution, metric_data, combo_format = 'names'):
+    '''Same as process_result, but for a block of combos from batch_metrics.
+
+    @param nodes: node names, indexed by the entries of combos
+    @param combos: (B x k) integer array of node indices
+    @param values: dict of metric, (array of values, duration) tuples.
+    @param point_id: id of the first combo, or an array of ids, one per combo
+    @param combo_format: how to write combos, in COMBO_FORMATS
+    '''
+    if numpy.isscalar(point_id):
+        point_ids = numpy.arange(point_id, point_id + len(combos))
+    else:
+        point_ids = numpy.asarray(point_id)
+    def combo_at(i):
+        if combo_format == 'rank':
+            return int(encode_combos(nodes, combos[i:i + 1])[0])
+        return tuple([nodes[j] for j in combos[i]])
+    for metric in metrics:
+        this_metric = metric_data[metric]
+        metric_values, duration = values[metric]
+        this_metric['duration'] += duration
+        lowest = metric_values.argmin()
+        if metric_values[lowest] < this_metric['lowest']:
+            this_metric['lowest'] = float(metric_values[lowest])
+            this_metric['lowest_combo'] = combo_at(lowest)
+        highest = metric_values.argmax()
+        if metric_values[highest] > this_metric['highest']:
+            this_metric['highest'] = float(metric_values[highest])
+            this_metric['highest_combo'] = combo_at(highest)
+        if median:
+            this_metric['sketch'].update(metric_values)
+        this_metric['sum'] += float(metric_values.sum())
+        this_metric['num'] += len(metric_values)
+
+    if write_dist and is_histogram(distribution):
+        for metric in metrics:
+            add_to_histogram(distribution[metric], values[metric][0])
+    elif write_dist and is_columnar(distribution):
+        distribution.add(point_ids, dict((metric, values[metric][0])
+                                         for metric in metrics))
+    elif write_dist:
+        columns = [(metric, values[metric][0].tolist()) for metric in metrics]
+        point_ids = point_ids.tolist()
+        if write_combos and combo_format == 'rank':
+            ranks = encode_combos(nodes, combos).tolist()
+        for i, combo in enumerate(combos):
+            json_entry = {'id': point_ids[i]}
+            for metric, metric_values in columns:
+                json_entry[metric] = metric_values[i]
+            if write_combos and combo_format == 'rank':
+                json_entry['combo'] = ranks[i]
+            elif write_combos:
+                json_entry['combo'] = tuple([nodes[j] for j in combo])
+            distribution.append(json_entry)
+
+
+def encode_combo(combo):
+    '''Returns the lexicographic rank of a combo of node names of g_g, in
+    combinations(sorted node names, k).'''
+    positions = sorted([g_node_positions[n] for n in combo])
+    return combination_rank(positions, len(g_node_positions))
+
+
+def encode_combos(nodes, combos):
+    '''Same as encode_combo, for a (B x k) block of indices into nodes.'''
+    positions = numpy.array([g_node_positions[n] for n in nodes])
+    return combination_ranks(numpy.sort(positions[combos], axis = 1),
+                             len(nodes))
 
 
 def handle_combos(combos, metrics, median, write_combos, write_dist, point_id):
@@ -494,14 +1845,85 @@ def handle_combos(combos, metrics, median, write_combos, write_dist, point_id):
         values = {}
         for metric in g_metrics:
             start_time = time.time()
-            metric_value = METRIC_FCNS[metric](g_g, combo, g_apsp, g_apsp_paths,
-                                               g_weighted, g_extra_params)
+            metric_value = get_metric_fcns(g_apsp)[metric](g_g, combo, g_apsp,
+                g_apsp_paths, g_weighted, g_extra_params)
             duration = time.time() - start_time
             values[metric] = (metric_value, duration)
         process_result(metrics, median, write_combos, write_dist, combo, values, point_id, distribution, metric_data)
         point_id += 1
     return [metric_data, distribution]
 
+def score_block(combos, point_id, metrics, median, write_combos, write_dist,
+                distribution, metric_data, combo_format = 'names'):
+    '''Compute metrics for a (B x k) block of node indices, in place.'''
+    nodes = list(g_g.nodes())
+    if USE_MATRIX and all([m in BATCH_METRICS for m in metrics]):
+        values = batch_metrics(g_apsp, combos, metrics)
+        process_batch_result(metrics, median, write_combos, write_dist, nodes,
+                             combos, values, point_id, distribution, metric_data,
+                             combo_format)
+    else:
+        for i, combo in enumerate(combos):
+            combo, values = handle_combo(tuple([nodes[j] for j in combo]))
+            process_result(metrics, median, write_combos, write_dist, combo,
+                           values, point_id + i, distribution, metric_data,
+                           combo_format)
+
+
+def handle_combo_block(args):
+    '''Handle processing for a block of combos; used with Pool.imap_unordered.
+
+    @param args: (state, combos, point_id, metrics, median, write_combos,
+        write_dist, dist_format, combo_format) tuple, with state from
+        ExecutionContext, combos a (B x k) integer array of node indices and
+        point_id the id of the block's first combo.
+    @return [metric_data, distribution] for the block
+    '''
+    (state, combos, point_id, metrics, median, write_combos, write_dist,
+     dist_format, combo_format) = args
+    load_worker_state(state)
+    metric_data = init_metric_data(metrics, median)
+    distribution = init_distribution(metrics, dist_format)
+    score_block(combos, point_id, metrics, median, write_combos, write_dist,
+                distribution, metric_data, combo_format)
+    return [metric_data, distribution]
+
+
+def rank_shards(num_combos, shards):
+    '''Split ranks [0, num_combos) into contiguous, evenly sized ranges.
+
+    @param num_combos: total number of combos
+    @param shards: number of ranges
+    @return list of (lo, hi) tuples, sizes differing by at most one
+    '''
+    return [(num_combos * i // shards, num_combos * (i + 1) // shards)
+            for i in range(shards)]
+
+
+def handle_combos_range(state, lo, hi, combo_size, metrics, median,
+                        write_combos, write_dist, point_id, dist_format,
+                        combo_format = 'names'):
+    '''Handle processing for the combos with lexicographic rank in [lo, hi).
+
+    The worker unranks lo and enumerates forward from there, so no worker
+    walks over combos belonging to another.
+
+    @param state: ExecutionContext state to evaluate against
+    @param point_id: id of the combo with rank 0
+    @return [metric_data, distribution] for the range
+    '''
+    load_worker_state(state)
+    metric_data = init_metric_data(metrics, median)
+    distribution = init_distribution(metrics, dist_format)
+    block_point_id = point_id + lo
+    for combos in combo_blocks(g_g.number_of_nodes(), combo_size, BATCH_SIZE,
+                               lo, hi):
+        score_block(combos, block_point_id, metrics, median, write_combos,
+                    write_dist, distribution, metric_data, combo_format)
+        block_point_id += len(combos)
+    return [metric_data, distribution]
+
+
 def init_random_select_controller(nodes, num_controller):
     '''
     return set of controller place
@@ -588,8 +2010,8 @@ def evaluate(controllers_list, g_g, g_apsp, g_apsp_paths, g_weighted, g_extra_pa
         for metric in g_metrics:
             start_time = time.time()
             # NOTE: 処理の実体はここ、metrics_libで定義されているget_latencyメソッドなどを呼び出す
-            metric_value = METRIC_FCNS[metric](g_g, combo, g_apsp, g_apsp_paths,
-                                                g_weighted, g_extra_params)
+            metric_value = get_metric_fcns(g_apsp)[metric](g_g, combo, g_apsp,
+                g_apsp_paths, g_weighted, g_extra_params)
             duration = time.time() - start_time
             values[metric] = (metric_value, duration)
         # NOTE: valuesにlatency,wc_latencyの結果が含まれる
@@ -601,8 +2023,8 @@ def metric_values(controllers, g_g, g_apsp, g_apsp_paths, g_weighted, g_extra_pa
     for metric in g_metrics:
         start_time = time.time()
         # NOTE: 処理の実体はここ、metrics_libで定義されているget_latencyメソッドなどを呼び出す
-        metric_value = METRIC_FCNS[metric](g_g, controllers, g_apsp, g_apsp_paths,
-                                            g_weighted, g_extra_params)
+        metric_value = get_metric_fcns(g_apsp)[metric](g_g, controllers,
+            g_apsp, g_apsp_paths, g_weighted, g_extra_params)
         duration = time.time() - start_time
         values[metric] = (metric_value, duration)
 
@@ -761,14 +2183,132 @@ def init_metric_data(metrics, median):
         this_metric['sum'] = 0.0
         this_metric['num'] = 0
         if median:
-            this_metric['values'] = []
+            # Bounded-memory quantiles; storing every value sends big runs
+            # to swap.
+            this_metric['sketch'] = QuantileSketch()
     return metric_data
 
 
-def init_distribution():
+g_bin_widths = HISTOGRAM_BIN_WIDTHS  # Histogram bin widths; see set_state.
+
+def init_distribution(metrics = None, dist_format = 'json'):
+    '''Returns an empty distribution.
+
+    @param metrics: metrics to make histograms for
+    @param dist_format: one of DIST_FORMATS
+    @return distribution: for 'json', a list of {id, combo, metric:value}
+        points, one per combo; for 'histogram', a dict of metric to
+        {bin_width, counts}, where counts maps str(bin index) to the number
+        of combos with value in [index * bin_width, (index + 1) * bin_width),
+        with bin widths from set_state.
+    '''
+    if dist_format == 'histogram':
+        return dict((metric, {'bin_width': g_bin_widths[metric],
+                              'counts': {}}) for metric in metrics)
+    if dist_format == 'npy':
+        return Columns(metrics)
     return [] # list of {combo, key:value}'s in JSON, per combo
 
 
+def is_histogram(distribution):
+    return isinstance(distribution, dict)
+
+
+def is_columnar(distribution):
+    return isinstance(distribution, (Columns, ColumnFiles))
+
+
+class Columns(object):
+    '''Per-combo point ids and metric values, as blocks of arrays.'''
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.ids = []
+        self.values = dict((metric, []) for metric in metrics)
+
+    def add(self, ids, values):
+        '''Append point ids and a dict of metric to values, one per combo.'''
+        self.ids.append(numpy.asarray(ids, dtype = numpy.int64))
+        for metric in self.metrics:
+            self.values[metric].append(numpy.asarray(values[metric],
+                                                     dtype = float))
+
+    def extend(self, columns):
+        self.ids += columns.ids
+        for metric in self.metrics:
+            self.values[metric] += columns.values[metric]
+
+
+class ColumnFiles(object):
+    '''Memory-mapped .npy columns holding the distribution for one k.
+
+    One file per metric plus a 'rank' file, with the lexicographic rank of
+    each row's combo; rows are written in the order results arrive.
+    '''
+
+    def __init__(self, dirpath, metrics, num_combos, point_id, rows = 0):
+        '''
+        @param dirpath: directory for the column files
+        @param num_combos: rows in each file
+        @param point_id: id of the combo with rank 0
+        @param rows: rows already written, when resuming; else files are created
+        '''
+        self.dirpath = dirpath
+        self.metrics = metrics
+        self.point_id = point_id
+        self.rows = rows
+        if not os.path.exists(dirpath):
+            os.makedirs(dirpath)
+        mode = 'r+' if rows else 'w+'
+        self.files = {}
+        for column in ['rank'] + list(metrics):
+            dtype = numpy.int64 if column == 'rank' else float
+            self.files[column] = numpy.lib.format.open_memmap(
+                self.filepath(column), mode = mode, dtype = dtype,
+                shape = (num_combos,))
+
+    def filepath(self, column):
+        return os.path.join(self.dirpath, column + '.npy')
+
+    def add(self, ids, values):
+        ids = numpy.asarray(ids, dtype = numpy.int64)
+        end = self.rows + len(ids)
+        self.files['rank'][self.rows:end] = ids - self.point_id
+        for metric in self.metrics:
+            self.files[metric][self.rows:end] = values[metric]
+        self.rows = end
+
+    def extend(self, columns):
+        for i, ids in enumerate(columns.ids):
+            self.add(ids, dict((metric, columns.values[metric][i])
+                               for metric in self.metrics))
+
+    def flush(self):
+        for column_file in self.files.values():
+            column_file.flush()
+
+    def to_json(self):
+        '''Returns the JSON stand-in for the distribution, naming its files.'''
+        self.flush()
+        return {
+            'format': 'npy',
+            'rows': self.rows,
+            'point_id': self.point_id,
+            'columns': dict((column, self.filepath(column))
+                            for column in self.files)
+        }
+
+
+def add_to_histogram(histogram, values):
+    '''Count values into the histogram of one metric.'''
+    bins = numpy.floor(numpy.asarray(values, dtype = float) /
+                       histogram['bin_width']).astype(int)
+    counts = histogram['counts']
+    for index, count in zip(*numpy.unique(bins, return_counts = True)):
+        key = str(index)
+        counts[key] = counts.get(key, 0) + int(count)
+
+
 def merge_metric_data(metric_data, metric_data_in, metrics, median):
     for metric in metrics:
         this_metric = metric_data[metric]
@@ -783,17 +2323,282 @@ def merge_metric_data(metric_data, metric_data_in, metrics, median):
         this_metric['sum'] += this_metric_in['sum']
         this_metric['num'] += this_metric_in['num']
         if median:
-            this_metric['values'] += this_metric_in['values']
+            this_metric['sketch'].merge(this_metric_in['sketch'])
 
 
 def merge_distribution(distribution, distribution_in):
-    distribution += distribution_in
+    if is_columnar(distribution):
+        distribution.extend(distribution_in)
+    elif is_histogram(distribution):
+        for metric, histogram_in in distribution_in.items():
+            counts = distribution[metric]['counts']
+            for key, count in histogram_in['counts'].items():
+                counts[key] = counts.get(key, 0) + count
+    else:
+        distribution += distribution_in
+
+
+def set_state(metrics, g, apsp, apsp_paths, weighted, extra_params):
+    '''Set the per-topology globals that metric evaluation reads.
+
+    @param apsp: DistanceMatrix, or all-pairs shortest paths data
+    '''
+    global g_metrics
+    global g_g
+    global g_apsp
+    global g_apsp_paths
+    global g_weighted
+    global g_extra_params
+    global g_node_positions
+    global g_bin_widths
+
+    g_metrics = metrics
+    g_g = g
+    g_apsp = apsp
+    g_apsp_paths = apsp_paths
+    g_weighted = weighted
+    g_extra_params = extra_params
+    # Position of each node in sorted order, for encode_combo.
+    g_node_positions = dict((n, i) for i, n in enumerate(sorted(g.nodes())))
+    # Latency histograms scale with the longest shortest path.
+    if isinstance(apsp, DistanceMatrix):
+        dist = apsp.dist
+    else:
+        dist = numpy.array([d for lengths in apsp.values()
+                            for d in lengths.values()])
+    g_bin_widths = histogram_bin_widths(dist[numpy.isfinite(dist)].max())
+
+
+g_state_generation = None  # Generation of the ExecutionContext state held.
+
+def load_worker_state(state):
+    '''Load the state an ExecutionContext published, unless already held.
+
+    @param state: (generation, shared memory block name, size) tuple
+    '''
+    global g_state_generation
+    generation, block_name, size = state
+    if generation == g_state_generation:
+        return
+    block = shared_memory.SharedMemory(name = block_name)
+    metrics, g, dm_spec, apsp, apsp_paths, weighted, extra_params = \
+        pickle.loads(bytes(block.buf[:size]))
+    block.close()
+    if dm_spec is not None:
+        apsp = DistanceMatrix.attach(dm_spec)
+    set_state(metrics, g, apsp, apsp_paths, weighted, extra_params)
+    g_state_generation = generation
+
+
+class ExecutionContext(object):
+    '''One worker pool, reused across combo sizes, runs and topologies.
+
+    Workers start once.  publish() swaps in the next topology by writing its
+    state to shared memory under a new generation number; every task carries
+    that (generation, block) handle, and each worker loads the state on its
+    first task of a new generation.
+
+    Use it in a with statement, or call close(), to stop the workers.
+    '''
+
+    def __init__(self, processes = None):
+        '''
+        @param processes: number of workers in pool; None for one per CPU
+        '''
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.processes = processes
+        # Workers must share our resource tracker; one started by a worker
+        # would unlink every block that worker attached to when it exits.
+        resource_tracker.ensure_running()
+        self.pool = multiprocessing.Pool(processes)
+        self.generation = 0
+        self.state = None  # Handle passed with each task.
+        self.state_block = None
+        self.dm = None
+
+    def publish(self, metrics, g, apsp, apsp_paths, weighted, extra_params):
+        '''Set the per-topology state, here and for every worker.
+
+        @param apsp: DistanceMatrix, or all-pairs shortest paths data
+        '''
+        self.release()
+        set_state(metrics, g, apsp, apsp_paths, weighted, extra_params)
+        if isinstance(apsp, DistanceMatrix):
+            # Workers attach to the matrices; they need no APSP dicts.
+            self.dm = apsp
+            worker_state = (metrics, g, apsp.share(), None, None, weighted,
+                            extra_params)
+        else:
+            worker_state = (metrics, g, None, apsp, apsp_paths, weighted,
+                            extra_params)
+        payload = pickle.dumps(worker_state, pickle.HIGHEST_PROTOCOL)
+        self.state_block = shared_memory.SharedMemory(create = True,
+                                                      size = len(payload))
+        self.state_block.buf[:len(payload)] = payload
+        self.generation += 1
+        self.state = (self.generation, self.state_block.name, len(payload))
+
+    def release(self):
+        '''Free the shared memory holding the current state.'''
+        if self.dm is not None:
+            self.dm.unlink()
+            self.dm = None
+        if self.state_block is not None:
+            self.state_block.close()
+            self.state_block.unlink()
+            self.state_block = None
+        self.state = None
+
+    def close(self):
+        '''Stop the workers and free the shared memory.'''
+        # Pool cleanup.  According to the Multiprocessing module docs,
+        # this shouldn't be necessary due to automatic GC, but without this
+        # code, worker processes seem to accumulate until you're out of memory.
+        # Even if it's just a slow GC performance bug and not a correctness one,
+        # it helps run the code on smaller VMs and should help performance a bit.
+        print("terminating pool")
+        self.pool.terminate()
+        print("joining pool")
+        self.pool.join()
+        self.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def run_combo_range(context, combo_size, lo, hi, point_id, metrics, median,
+                    write_combos, write_dist, chunksize, enumeration,
+                    metric_data, distribution, dist_format = 'json',
+                    combo_format = 'names'):
+    '''Evaluate the combos with lexicographic rank in [lo, hi), in place.
+
+    @param context: ExecutionContext with the state published, or None to
+        run serially
+    @param point_id: id of the combo with rank 0
+    '''
+    num_nodes = g_g.number_of_nodes()
+    if context:
+        pool = context.pool
+        processes = context.processes
+    if context and COARSE:
+        # Give each worker one contiguous range of combination ranks.
+        print("dispatch each thread")
+        results_async = []
+        for shard_lo, shard_hi in rank_shards(hi - lo, processes):
+            result_async = pool.apply_async(handle_combos_range, (context.state, lo + shard_lo, lo + shard_hi, combo_size, metrics, median, write_combos, write_dist, point_id, dist_format, combo_format))
+            results_async.append(result_async)
+            # handle_combos_range returns a [metric_data, distribution] result.
+
+        # Wait for results from each thread)
+        print("collecting and merging results")
+        for r in results_async:
+            metric_data_in, distribution_in = r.get()
+            assert r.successful()
+            merge_metric_data(metric_data, metric_data_in, metrics, median)
+            merge_distribution(distribution, distribution_in)
+
+    elif context and not COARSE:
+        # Stream fixed-size blocks of combos to the workers, with a
+        # bounded number in flight, and merge results in submission order.
+        # Blocks are submitted from this thread, never from the pool's task
+        # handler, so a failed block raises here and the pool can still be
+        # terminated.
+        pending = collections.deque()
+        def merge_oldest():
+            metric_data_in, distribution_in = pending.popleft().get()
+            merge_metric_data(metric_data, metric_data_in, metrics, median)
+            merge_distribution(distribution, distribution_in)
+        block_point_id = point_id + lo
+        for combos in combo_blocks(num_nodes, combo_size, chunksize, lo, hi):
+            if len(pending) == processes * IN_FLIGHT_PER_PROCESS:
+                merge_oldest()
+            pending.append(pool.apply_async(handle_combo_block,
+                ((context.state, combos, block_point_id, metrics, median,
+                  write_combos, write_dist, dist_format, combo_format),)))
+            block_point_id += len(combos)
+        while pending:
+            merge_oldest()
+    elif enumeration == 'revolving_door':
+        assert USE_MATRIX
+        assert (lo, hi) == (0, choose(num_nodes, combo_size))
+        for combos, values in revolving_door_blocks(g_apsp, combo_size, metrics):
+            # Ids follow rank, as with the other enumerations.
+            point_ids = point_id + combination_ranks(combos, num_nodes)
+            process_batch_result(metrics, median, write_combos, write_dist,
+                                 g_apsp.nodes, combos, values, point_ids,
+                                 distribution, metric_data, combo_format)
+    elif USE_MATRIX and all([m in BATCH_METRICS for m in metrics]):
+        point_id += lo
+        for combos in combo_blocks(num_nodes, combo_size, BATCH_SIZE, lo, hi):
+            values = batch_metrics(g_apsp, combos, metrics)
+            process_batch_result(metrics, median, write_combos, write_dist,
+                                 g_apsp.nodes, combos, values, point_id,
+                                 distribution, metric_data, combo_format)
+            point_id += len(combos)
+    else:
+        nodes = list(g_g.nodes())
+        point_id += lo
+        for combo in combinations_range(num_nodes, combo_size, lo, hi):
+            combo, values = handle_combo(tuple([nodes[i] for i in combo]))
+            process_result(metrics, median, write_combos, write_dist, combo, values, point_id, distribution, metric_data, combo_format)
+            point_id += 1
+
+
+def checkpoint_params(metrics, g, num_controllers, median, write_dist,
+                      write_combos, enumeration, dist_format,
+                      combo_format = 'names'):
+    '''Return the run parameters a checkpoint must match to be resumed.'''
+    return {
+        'metrics': list(metrics),
+        'nodes': [str(n) for n in g.nodes()],
+        'num_controllers': sorted(num_controllers),
+        'median': median,
+        'write_dist': write_dist,
+        'write_combos': write_combos,
+        'enumeration': enumeration,
+        'dist_format': dist_format,
+        'combo_format': combo_format
+    }
+
+
+def checkpoint_json_default(o):
+    '''Serialize the non-JSON objects in metric_data and distributions.'''
+    if isinstance(o, (QuantileSketch, ColumnFiles)):
+        return o.to_json()
+    return o.tolist()
+
+
+def write_checkpoint(filepath, checkpoint_data):
+    '''Atomically write checkpoint JSON, so a crash never leaves half a file.'''
+    dirname = os.path.dirname(filepath)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    tmp_filepath = filepath + '.tmp'
+    with open(tmp_filepath, 'w') as f:
+        json.dump(checkpoint_data, f, default = checkpoint_json_default)
+    os.replace(tmp_filepath, filepath)
+    print("wrote checkpoint %s at combo size %s, position %s" %
+          (filepath, checkpoint_data['combo_size'], checkpoint_data['position']))
+
+
+def read_checkpoint(filepath):
+    '''Read checkpoint JSON written by write_checkpoint.'''
+    with open(filepath, 'r') as f:
+        return json.load(f)
 
 
 def run_all_combos(metrics, g, num_controllers, data, apsp, apsp_paths,
                    weighted = False, write_dist = False, write_combos = False,
                    extra_params = None, processes = None, multiprocess = False,
-                   chunksize = 1, median = False):
+                   chunksize = 1, median = False, enumeration = 'lexicographic',
+                   checkpoint = None, resume = False,
+                   checkpoint_interval = CHECKPOINT_INTERVAL, context = None,
+                   dist_format = 'json', dist_path = None,
+                   combo_format = 'names'):
     '''Compute best, worst, and mean/median latencies, plus fairness.
 
     @param metrics: metrics to compute: in ['latency', 'fairness']
@@ -810,157 +2615,768 @@ def run_all_combos(metrics, g, num_controllers, data, apsp, apsp_paths,
     @param processes: number of workers in pool
     @param multiprocess: use multiple processes?
     @param chunksize: chunksize for multiprocess map
+    @param median: compute median?
+    @param enumeration: order in which to enumerate combos, in ENUMERATIONS;
+        'revolving_door' updates nearest controllers incrementally, runs
+        serially, and supports only INCREMENTAL_METRICS.
+    @param checkpoint: filepath to periodically save progress to, or None;
+        removed once all combo sizes finish.  A written distribution must
+        be 'npy' or 'histogram', as each checkpoint saves it whole.
+    @param resume: continue from the checkpoint, if one exists?
+    @param checkpoint_interval: min seconds between checkpoint writes.
+    @param context: ExecutionContext whose pool to use when multiprocess is
+        set, or None to start (and stop) a pool of processes workers.
+    @param dist_format: format of the distribution written with write_dist,
+        in DIST_FORMATS; see init_distribution.
+    @param dist_path: directory for 'npy' distributions, which go in
+        <dist_path>/<k>/<column>.npy, with the group's distribution naming
+        those files.
+    @param combo_format: how to write combos, in COMBO_FORMATS; with 'rank',
+        data['combo_nodes'] lists the sorted node names ranks refer to.
     '''
-    
-    # Ugly hack to effectively write our reused objects to shared memory
-    global g_metrics
-    global g_g
-    global g_apsp
-    global g_apsp_paths
-    global g_weighted
-    global g_extra_params
-    
-    g_metrics = metrics
-    g_g = g
-    g_apsp = dict(apsp)
-    g_apsp_paths = dict(apsp_paths)
-    g_weighted = weighted
-    g_extra_params = extra_params
+    if dist_format == 'npy' and not write_dist:
+        dist_format = 'json'  # No columns to write.
+    if dist_format == 'npy' and not dist_path:
+        raise Exception("npy distributions need a dist_path")
+    if checkpoint and write_dist and dist_format == 'json':
+        # Every checkpoint would rewrite every point so far.
+        raise Exception("checkpoints need an npy or histogram distribution")
+    apsp = dict(apsp)
+    apsp_paths = dict(apsp_paths)
+    if USE_MATRIX:
+        apsp = DistanceMatrix(g, apsp, apsp_paths)
+        if depth_sweep(metrics):
+            # One pass over failure sets gives every per-depth table.
+            engine = apsp.availability_engine(g, weighted,
+                                              extra_params['link_fail_prob'])
+            apsp.depth_availability = engine.depth_availability(
+                depth_sweep(metrics))
+        if 'availability' in metrics:
+            # Score every failure set against every path once, up front;
+            # each combo is then a lookup in the resulting table.
+            engine = apsp.availability_engine(g, weighted,
+                                              extra_params['link_fail_prob'])
+            depth = availability_depth(g, weighted, extra_params)
+            coverage = sum(failure_count_probs(link_fail_probs(g, weighted,
+                extra_params['link_fail_prob']), depth))
+            print("availability: up to %s failures, coverage %s" %
+                  (depth, coverage))
+            apsp.path_availability = engine.path_availability(depth)
+        if 'availability_reroute' in metrics:
+            # Failure states are the same for every combo; only which
+            # components hold a controller differs.
+            engine = apsp.availability_engine(g, weighted,
+                                              extra_params['link_fail_prob'])
+            apsp.reroute_labels, apsp.reroute_probs = engine.reroute_table(
+                availability_depth(g, weighted, extra_params))
+        apsp.engine = None  # Only the tables go to workers.
+
+    if enumeration == 'revolving_door':
+        multiprocess = False
+
+    own_context = multiprocess and context is None
+    if own_context:
+        context = ExecutionContext(processes)
+    try:
+        if multiprocess:
+            context.publish(metrics, g, apsp, apsp_paths, weighted, extra_params)
+        else:
+            context = None
+            set_state(metrics, g, apsp, apsp_paths, weighted, extra_params)
+
+        checkpoint_data = None
+        if resume and checkpoint and os.path.exists(checkpoint):
+            checkpoint_data = read_checkpoint(checkpoint)
+            expected = checkpoint_params(metrics, g, num_controllers, median,
+                                         write_dist, write_combos, enumeration,
+                                         dist_format, combo_format)
+            for key, value in expected.items():
+                if checkpoint_data.get(key) != value:
+                    raise Exception("checkpoint %s has %s = %s, not %s" %
+                                    (checkpoint, key, checkpoint_data.get(key), value))
+            print("resuming from %s" % checkpoint)
+        last_checkpoint = time.time()
+
+        point_id = 0  # Unique index for every distribution point written out.
+        data['data'] = {}  # Where all data point & aggregates are stored.
+        if checkpoint_data:
+            data['data'] = checkpoint_data['done']
+        for combo_size in sorted(num_controllers):
+            # compute best location(s) for i controllers.
+            num_combos = choose(g.number_of_nodes(), combo_size)
+            if str(combo_size) in data['data']:
+                # Finished before the checkpoint was written.
+                point_id += num_combos
+                continue
+
+            print("** combo size: %s" % combo_size)
+
+            # Initialize metric tracking data
+            metric_data = init_metric_data(metrics, median)
+            distribution = init_distribution(metrics, dist_format)
+            position = 0  # Rank of the next combo to evaluate.
+            if checkpoint_data and checkpoint_data['combo_size'] == combo_size:
+                metric_data = checkpoint_data['metric_data']
+                if median:
+                    for metric in metrics:
+                        metric_data[metric]['sketch'] = QuantileSketch.from_json(
+                            metric_data[metric]['sketch'])
+                distribution = checkpoint_data['distribution']
+                position = checkpoint_data['position']
+            if dist_format == 'npy':
+                # Rows past position may hold partial results from before a
+                # resume; they get overwritten.
+                rows = distribution['rows'] if isinstance(distribution, dict) else 0
+                distribution = ColumnFiles(os.path.join(dist_path, str(combo_size)),
+                                           metrics, num_combos, point_id, rows)
+
+            # Revolving-door order is not rank order, so it can only stop
+            # between combo sizes.
+            segment = num_combos
+            if checkpoint and enumeration != 'revolving_door':
+                segment = CHECKPOINT_COMBOS
+            while position < num_combos:
+                hi = min(position + segment, num_combos)
+                run_combo_range(context, combo_size, position, hi, point_id,
+                                metrics, median, write_combos, write_dist,
+                                chunksize, enumeration, metric_data, distribution,
+                                dist_format, combo_format)
+                position = hi
+                if checkpoint and time.time() - last_checkpoint >= checkpoint_interval:
+                    checkpoint_data = checkpoint_params(metrics, g, num_controllers,
+                        median, write_dist, write_combos, enumeration, dist_format,
+                        combo_format)
+                    checkpoint_data['done'] = data['data']
+                    checkpoint_data['combo_size'] = combo_size
+                    checkpoint_data['position'] = position
+                    checkpoint_data['metric_data'] = metric_data
+                    checkpoint_data['distribution'] = distribution
+                    write_checkpoint(checkpoint, checkpoint_data)
+                    last_checkpoint = time.time()
+            point_id += num_combos
+
+            # Compute summary stats
+            for metric in metrics:
+                this_metric = metric_data[metric]
+                # Previously, we stored all values - but with so many,
+                # the storage of these values must go to disk swap and the CPU
+                # usage drops to 1% waiting on disk.
+                #this_metric['mean'] = sum(this_metric['values']) / len(this_metric['values'])
+                this_metric['mean'] = this_metric['sum'] / float(this_metric['num'])
+                if median:
+                    sketch = this_metric.pop('sketch')
+                    quantiles = sketch.quantiles([0.5] + [p / 100.0 for p in PERCENTILES])
+                    this_metric['median'] = quantiles[0]
+                    for p, value in zip(PERCENTILES, quantiles[1:]):
+                        this_metric['p%s' % p] = value
+                    this_metric['quantile_rank_error'] = sketch.rank_error()
+                if combo_format == 'names':
+                    # Work around Python annoyance where str(set) doesn't work
+                    this_metric['lowest_combo'] = list(this_metric['lowest_combo'])
+                    this_metric['highest_combo'] = list(this_metric['highest_combo'])
+
+                if PRINT_VERBOSE:
+                    print("\t" + "%s" % metric)
+                    for key in sorted(this_metric.keys()):
+                        print("\t\t%s: %s" % (key, this_metric[key]))
 
-    if multiprocess:
-        pool = multiprocessing.Pool(processes)
+            data['data'][str(combo_size)] = {}
+            group_data = data['data'][str(combo_size)]
+            for metric in metrics:
+                group_data[metric] = metric_data[metric]
+            if is_columnar(distribution):
+                distribution = distribution.to_json()
+            group_data['distribution'] = distribution
+
+        data['metric'] = metrics
+        data['group'] = [str(c) for c in num_controllers]
+        if combo_format == 'rank':
+            data['combo_nodes'] = sorted(g.nodes())
+
+        if checkpoint and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+    finally:
+        # Free the pool and shared memory even if a worker or the reduce
+        # loop fails.
+        if own_context:
+            context.close()
+        elif context is not None:
+            context.release()
+
+
+def greedy_kmedian(dist, k):
+    '''Returns a good combo for total latency: greedy adds, then 1-swaps.
+
+    @param dist: (n x n) distance matrix
+    @param k: number of controllers
+    @return combo: list of node indices
+    @return total: total path length from each node to its closest controller
+    '''
+    n = len(dist)
+    combo = []
+    nearest = numpy.full(n, numpy.inf)
+    for i in range(k):
+        totals = numpy.minimum(nearest[:, numpy.newaxis], dist).sum(axis = 0)
+        totals[combo] = numpy.inf
+        best = int(totals.argmin())
+        combo.append(best)
+        nearest = numpy.minimum(nearest, dist[:, best])
+    total = nearest.sum()
+
+    improved = True
+    while improved:
+        improved = False
+        for i in range(k):
+            rest_nearest = numpy.full(n, numpy.inf)
+            if k > 1:
+                rest_nearest = dist[:, combo[:i] + combo[i + 1:]].min(axis = 1)
+            totals = numpy.minimum(rest_nearest[:, numpy.newaxis], dist).sum(axis = 0)
+            totals[combo] = numpy.inf
+            best = int(totals.argmin())
+            if totals[best] < total:
+                combo[i] = best
+                total = totals[best]
+                improved = True
+    return combo, total
+
+
+def kmedian_multipliers(dist_t, k, lam, combo, upper):
+    '''Returns multipliers for the Lagrangian k-median lower bound.
+
+    Relaxing "each switch has one controller" with a multiplier lam[j] per
+    switch j gives each candidate i the reduced cost
+    rho[i] = sum_j min(0, dist[i, j] - lam[j]).  For any lam, every combo
+    totals at least sum(lam) plus the rho of its controllers, so sum(lam)
+    plus the k lowest rho is a lower bound.  Subgradient ascent raises it
+    toward the LP relaxation bound.  The k lowest-rho candidates at each
+    step are also tried as combos, which often improves on upper.
+
+    @param dist_t: transposed distance matrix
+    @param k: number of controllers
+    @param lam: starting multipliers, one per switch
+    @param combo: node indices of a known combo
+    @param upper: total of combo
+    @return lam: best multipliers found
+    @return bound: lower bound they give
+    @return combo: best combo found
+    @return upper: total of combo
+    '''
+    best_lam = lam
+    best_bound = -numpy.inf
+    step = LAGRANGIAN_STEP
+    stalled = 0
+    for i in range(LAGRANGIAN_ITERATIONS):
+        reduced = numpy.minimum(dist_t - lam, 0)
+        rho = reduced.sum(axis = 1)
+        chosen = numpy.argpartition(rho, k - 1)[:k]
+        total = dist_t[chosen].min(axis = 0).sum()
+        if total < upper:
+            combo = [int(c) for c in chosen]
+            upper = total
+        bound = lam.sum() + rho[chosen].sum()
+        if bound > best_bound:
+            best_lam = lam
+            best_bound = bound
+            stalled = 0
+        else:
+            stalled += 1
+            if stalled == LAGRANGIAN_PATIENCE:
+                step /= 2
+                stalled = 0
+        # Each switch should be taken by exactly one chosen controller.
+        grad = 1.0 - (reduced[chosen] < 0).sum(axis = 0)
+        norm = (grad ** 2).sum()
+        if norm == 0 or upper - best_bound < LAGRANGIAN_TOLERANCE * upper:
+            break
+        lam = numpy.maximum(lam + step * (upper - bound) / norm * grad, 0)
+    return best_lam, best_bound, combo, upper
 
-    point_id = 0  # Unique index for every distribution point written out.
-    data['data'] = {}  # Where all data point & aggregates are stored.
-    for combo_size in sorted(num_controllers):
-        # compute best location(s) for i controllers.
 
-        print("** combo size: %s" % combo_size)
+def kmedian_search_data(dist_t, lam):
+    '''Returns the arrays kmedian_subtree searches with.
 
-        # Initialize metric tracking data
-        metric_data = init_metric_data(metrics, median)
-        distribution = [] # list of {combo, key:value}'s in JSON, per combo
-
-        if multiprocess and COARSE:
-
-            #all_combos = combinations(g.nodes(), combo_size)
-            print("dispatch each thread")
-            results_async = []
-            for p in range(processes):
-                result_async = pool.apply_async(handle_combos_all, (g_g, g_metrics, g_apsp, g_apsp_paths, g_weighted, g_extra_params, p, processes, combo_size, metrics, median, write_combos, write_dist, point_id))
-                results_async.append(result_async)
-                # handle_combos returns a [metric_data, distribution] result.
-
-
-            # Wait for results from each thread)
-            print("collecting and merging results")
-            results = []
-            for r in results_async:
-                metric_data_in, distribution_in = r.get()
-                # print("==========metric_data_in")
-                # print(metric_data_in)
-                # print("==========distribution_in")
-                # print(distribution_in)
-                assert r.successful()
-                merge_metric_data(metric_data, metric_data_in, metrics, median)
-                merge_distribution(distribution, distribution_in)
-                results.append([metric_data_in, distribution_in])
-
-        elif multiprocess and not COARSE:
-            #results = pool.map(handle_combo, combinations(g.nodes(), combo_size),
-            #                   chunksize)
-            all_combos = combinations(g.nodes(), combo_size)
-            print("=========all_combos")
-            print(all_combos)
-            done = False
-            while not done:
-                #print "starting a dispatch round"
-                # Dispatch to each thread up to chunksize
-                results_async = []
-                p = 0
-                while p < processes and not done:
-                    for chunk in range(chunksize):
-                        #print "chunk %s id %s" % (chunk, point_id)
-                        combos = []
-                        try:
-                            combos.append(all_combos.next())
-                            point_id += 1
-                        except StopIteration:
-                            done = True
-                        finally:
-                            if combos:
-                                result_async = pool.apply_async(handle_combos, (combos, metrics, median, write_combos, write_dist, point_id))
-                                results_async.append(result_async)
-                            # handle_combos returns a [metric_data, distribution] result.
-                        if done:
-                            break
-                    p += 1
-                # Wait for results from each thread
-                #print "waiting for results"
-                results = []
-                for r in results_async:
-                    got = r.get()
-                    assert r.successful()
-                    results.append(got)
-
-                # Merge results from each thread
-                #print "merging results"
-                for metric_data_in, distribution_in in results:
-                    merge_metric_data(metric_data, metric_data_in, metrics, median)
-                    merge_distribution(distribution, distribution_in)
-
-            #for combo, values in results:
-            #    process_result(combo, values, point_id, distribution, metric_data)
-            #    point_id += 1
+    @param dist_t: transposed distance matrix
+    @param lam: Lagrangian multipliers from kmedian_multipliers
+    @return order: candidate node indices, in search order
+    @return suffix: (best, best_arg, second) arrays; row pos has, for each
+        switch, the closest and second-closest distance to order[pos:], and
+        the index of the closest.
+    @return in_suffix: in_suffix[pos, j] is whether j is in order[pos:]
+    @return rho: reduced cost of each candidate in order, for lam
+    '''
+    n = dist_t.shape[0]
+    rho = numpy.minimum(dist_t - lam, 0).sum(axis = 1)
+    # Most promising candidates first, so good combos are found early and
+    # the suffixes left to later subtrees hold weak candidates.
+    order = numpy.argsort(rho, kind = 'stable')
+
+    # Closest and second-closest distance to each suffix of order.
+    suffix_best = numpy.full((n + 1, n), numpy.inf)
+    suffix_best_arg = numpy.full((n + 1, n), -1)
+    suffix_second = numpy.full((n + 1, n), numpy.inf)
+    in_suffix = numpy.zeros((n + 1, n), dtype = bool)
+    for pos in range(n - 1, -1, -1):
+        col = dist_t[order[pos]]
+        closer = col < suffix_best[pos + 1]
+        suffix_second[pos] = numpy.where(closer, suffix_best[pos + 1],
+            numpy.minimum(suffix_second[pos + 1], col))
+        suffix_best[pos] = numpy.where(closer, col, suffix_best[pos + 1])
+        suffix_best_arg[pos] = numpy.where(closer, order[pos],
+                                           suffix_best_arg[pos + 1])
+        in_suffix[pos] = in_suffix[pos + 1]
+        in_suffix[pos, order[pos]] = True
+    suffix = (suffix_best, suffix_best_arg, suffix_second)
+    return order, suffix, in_suffix, rho[order]
+
+
+def kmedian_subtree(dist_t, search_data, lam, k, first, upper):
+    '''Branch-and-bound search of the k-median subtree under one candidate.
+
+    Candidates are only added in increasing position in order, so a subtree
+    at position pos can only add controllers from order[pos:].  A search
+    node is pruned if any of three lower bounds reaches the incumbent:
+
+    - each switch takes its distance to the closest of the remaining
+      candidates (other than itself), less the best-case zero distance for
+      as many switches as controllers remain;
+    - savings are subadditive, so adding controllers saves at most the sum
+      of what each would save on its own;
+    - the Lagrangian bound: each switch pays at most the lower of its
+      multiplier and its distance to the chosen controllers, less the
+      lowest reduced costs among the remaining candidates.
+
+    @param dist_t: transposed distance matrix
+    @param search_data: (order, suffix, in_suffix, rho) from
+        kmedian_search_data
+    @param lam: Lagrangian multipliers rho was computed with
+    @param k: number of controllers
+    @param first: position in order of the subtree's first controller
+    @param upper: incumbent total to beat
+    @return total: best total found, or upper if none was better
+    @return combo: node indices for total, or None if none beat upper
+    @return explored: number of search nodes explored
+    '''
+    order, suffix, in_suffix, rho = search_data
+    suffix_best, suffix_best_arg, suffix_second = suffix
+    n = len(order)
+    switches = numpy.arange(dist_t.shape[1])
+    best = [upper, None]
+    explored = [0]
+    # Ties with the incumbent need not be searched; allow for rounding.
+    slack = LAGRANGIAN_TOLERANCE * upper
+
+    def search(pos, chosen, nearest):
+        explored[0] += 1
+        remaining = k - len(chosen)
+        if remaining == 0:
+            total = nearest.sum()
+            if total < best[0]:
+                best[0] = total
+                best[1] = list(chosen)
+            return
+        if n - pos < remaining:
+            return
+        # rho is sorted, so the lowest remaining reduced costs come first.
+        lagrangian = numpy.minimum(lam, nearest).sum() - slack
+        if lagrangian + rho[pos:pos + remaining].sum() >= best[0]:
+            return
+        other = numpy.where(suffix_best_arg[pos] == switches,
+                            suffix_second[pos], suffix_best[pos])
+        bound_each = numpy.minimum(nearest, other)
+        savings = bound_each[in_suffix[pos]]
+        if len(savings) > remaining:
+            savings = numpy.partition(savings, -remaining)[-remaining:]
+        if bound_each.sum() - savings.sum() >= best[0]:
+            return
+        gains = numpy.maximum(nearest - dist_t[order[pos:]], 0).sum(axis = 1)
+        if len(gains) > remaining:
+            gains = numpy.partition(gains, -remaining)[-remaining:]
+        if nearest.sum() - gains.sum() >= best[0]:
+            return
+        for i in range(pos, n - remaining + 1):
+            if lagrangian + rho[i:i + remaining].sum() >= best[0]:
+                # Later candidates only have higher reduced costs.
+                break
+            chosen.append(order[i])
+            search(i + 1, chosen, numpy.minimum(nearest, dist_t[order[i]]))
+            chosen.pop()
+
+    search(first + 1, [order[first]], dist_t[order[first]])
+    return best[0], best[1], explored[0]
+
+
+def handle_kmedian_subtree(args):
+    '''Search one k-median subtree over the published distance matrix.
+
+    @param args: (state, lam, k, first, upper) tuple; state is the
+        ExecutionContext handle, and the rest are as for kmedian_subtree
+    '''
+    state, lam, k, first, upper = args
+    load_worker_state(state)
+    dist_t = g_apsp.dist.T
+    return kmedian_subtree(dist_t, kmedian_search_data(dist_t, lam), lam, k,
+                           first, upper)
+
+
+def kmedian_bnb(dm, k, context = None):
+    '''Find the combo with the lowest average latency, via branch-and-bound.
+
+    Starts from a greedy + 1-swap incumbent and Lagrangian multipliers
+    from subgradient ascent, which usually bound the optimum within a
+    fraction of a percent.  Subtrees under each first controller are
+    independent; given a context, they are searched in parallel by its
+    workers, each starting from the same incumbent.
+
+    @param dm: DistanceMatrix
+    @param k: number of controllers
+    @param context: ExecutionContext with dm published, or None to run
+        serially
+    @return solution: dict with lowest, lowest_combo, lower_bound and
+        explored keys
+    '''
+    n = len(dm.nodes)
+    dist_t = dm.dist.T
+    combo, total = greedy_kmedian(dm.dist, k)
+    lam, lower_bound, combo, total = kmedian_multipliers(
+        dist_t, k, dist_t[combo].min(axis = 0), combo, total)
+    explored = 0
+    if lower_bound < total * (1 - LAGRANGIAN_TOLERANCE):
+        search_data = kmedian_search_data(dist_t, lam)
+        # Subtrees whose first candidate alone busts the bound are skipped.
+        lam_sum = lam.sum() - LAGRANGIAN_TOLERANCE * total
+        firsts = [first for first in range(n - k + 1)
+                  if lam_sum + search_data[3][first:first + k].sum() < total]
+        if context:
+            tasks = [(context.state, lam, k, first, total) for first in firsts]
+            results = context.pool.map(handle_kmedian_subtree, tasks, 1)
         else:
-            #results = map(handle_combo, combinations(g.nodes(), combo_size))
-            for combo in combinations(g.nodes(), combo_size):
-                combo, values = handle_combo(combo)
-                process_result(metrics, median, write_combos, write_dist, combo, values, point_id, distribution, metric_data)
-                point_id += 1
+            results = [kmedian_subtree(dist_t, search_data, lam, k, first,
+                                       total) for first in firsts]
+        for subtree_total, subtree_combo, subtree_explored in results:
+            explored += subtree_explored
+            if subtree_combo is not None and subtree_total < total:
+                combo = subtree_combo
+                total = subtree_total
+    return {
+        'lowest': float(total) / n,
+        'lowest_combo': sorted([dm.nodes[i] for i in combo]),
+        'lower_bound': float(lower_bound) / n,
+        'explored': explored
+    }
+
+
+def popcount(mask):
+    '''Returns the number of bits set in an integer bitmask.'''
+    return bin(mask).count('1')
+
+
+def cover_search(balls, coverers, reach, order, uncovered, remaining, failed,
+                 explored):
+    '''Exact search for at most remaining balls covering uncovered.
+
+    Branches on the candidates that cover the uncovered switch with the
+    fewest such candidates, largest new coverage first.  A search node is
+    pruned when a greedy packing finds more uncovered switches than balls
+    remain, where no single ball can cover two packed switches.
+
+    @param balls: bitmask of switches covered by each candidate
+    @param coverers: candidate indices covering each switch
+    @param reach: bitmask of switches sharing a candidate with each switch
+    @param order: switches, fewest coverers first
+    @param uncovered: bitmask of switches still to cover
+    @param remaining: number of balls still allowed
+    @param failed: set of (uncovered, remaining) states known to fail
+    @param explored: one-element list; incremented per search node
+    @return combo: list of candidate indices, or None if no cover exists
+    '''
+    if uncovered == 0:
+        return []
+    if remaining == 0 or (uncovered, remaining) in failed:
+        return None
+    explored[0] += 1
+    hardest = None
+    packed = 0
+    blocked = 0
+    for s in order:
+        if uncovered >> s & 1 and not blocked >> s & 1:
+            if hardest is None:
+                hardest = s
+            packed += 1
+            blocked |= reach[s]
+            if packed > remaining:
+                failed.add((uncovered, remaining))
+                return None
+    for j in sorted(coverers[hardest],
+                    key = lambda j: -popcount(balls[j] & uncovered)):
+        combo = cover_search(balls, coverers, reach, order,
+                             uncovered & ~balls[j], remaining - 1, failed,
+                             explored)
+        if combo is not None:
+            return [j] + combo
+    failed.add((uncovered, remaining))
+    return None
+
+
+def cover_within(dist, radius, k, explored):
+    '''Returns k or fewer controllers within radius of every switch, or None.
+
+    @param dist: (n x n) distance matrix
+    @param radius: max allowed switch-to-controller distance
+    @param k: max number of controllers
+    @param explored: one-element list; incremented per search node
+    @return combo: list of node indices, or None
+    '''
+    n = len(dist)
+    within = dist <= radius
+    # balls[j] has bit s set if controller j would cover switch s.
+    balls = []
+    for j in range(n):
+        ball = 0
+        for s in numpy.nonzero(within[:, j])[0]:
+            ball |= 1 << int(s)
+        balls.append(ball)
+    # Drop candidates whose ball is contained in another candidate's.
+    candidates = []
+    for j in sorted(range(n), key = lambda j: -popcount(balls[j])):
+        if not any([balls[j] & ~balls[i] == 0 for i in candidates]):
+            candidates.append(j)
+    coverers = [[j for j in candidates if balls[j] >> s & 1] for s in range(n)]
+    reach = []
+    for s in range(n):
+        mask = 0
+        for j in coverers[s]:
+            mask |= balls[j]
+        reach.append(mask)
+    order = sorted(range(n), key = lambda s: len(coverers[s]))
+    return cover_search(balls, coverers, reach, order, (1 << n) - 1, k,
+                        set([]), explored)
+
+
+def kcenter_exact(dm, k, context = None):
+    '''Find the combo with the lowest worst-case latency, exactly.
+
+    Binary-searches the sorted distinct distances for the smallest radius at
+    which k controllers can cover every switch, deciding each radius with an
+    exact set-cover search over bitset coverage balls.  Farthest-first
+    traversal gives the initial upper bound.
+
+    @param dm: DistanceMatrix
+    @param k: number of controllers
+    @param context: unused; present to match SOLVER_FCNS
+    @return solution: dict with lowest, lowest_combo, explored and
+        radii_tested keys
+    '''
+    dist = dm.dist
+    n = len(dm.nodes)
+    # Farthest-first traversal, from the best single controller.
+    combo = [int(dist.max(axis = 0).argmin())]
+    nearest = dist[:, combo[0]].copy()
+    while len(combo) < k:
+        farthest = int(nearest.argmax())
+        combo.append(farthest)
+        nearest = numpy.minimum(nearest, dist[:, farthest])
+    radii = numpy.unique(dist)
+    lo = 0
+    hi = int(numpy.searchsorted(radii, nearest.max()))
+    explored = [0]
+    radii_tested = 0
+    while lo < hi:
+        mid = (lo + hi) // 2
+        radii_tested += 1
+        cover = cover_within(dist, radii[mid], k, explored)
+        if cover is not None:
+            hi = mid
+            combo = cover
+        else:
+            lo = mid + 1
+    # A cover may use fewer than k controllers; pad with any other nodes.
+    combo = combo + [i for i in range(n) if i not in combo][:k - len(combo)]
+    return {
+        'lowest': float(dist[:, combo].min(axis = 1).max()),
+        'lowest_combo': sorted([dm.nodes[i] for i in combo]),
+        'explored': explored[0],
+        'radii_tested': radii_tested
+    }
+
+
+def placement_milp(dm, k, objective):
+    '''Solve controller placement as a mixed-integer program with HiGHS.
+
+    Variables are y[j] (binary; controller at node j) and x[i][j]
+    (continuous; fraction of switch i assigned to controller j), with
+    sum_j x[i][j] = 1, x[i][j] <= y[j] and sum_j y[j] = k.
+
+    @param dm: DistanceMatrix
+    @param k: number of controllers
+    @param objective: 'latency' to minimize total distance, or 'wc_latency'
+        to minimize z, with sum_j d[i][j] x[i][j] <= z for every switch i
+    @return solution: dict with lowest, lowest_combo, mip_gap, solve_time
+        and status keys
+    '''
+    try:
+        from scipy.optimize import milp, LinearConstraint, Bounds
+        from scipy.sparse import coo_matrix
+    except ImportError:
+        raise Exception("MILP solver requires scipy >= 1.9 (scipy.optimize.milp)")
+
+    dist = dm.dist
+    n = len(dm.nodes)
+    num_x = n * n
+    # Column layout: y[0..n), then x[i][j] at n + i * n + j, then z.
+    num_vars = n + num_x + (1 if objective == 'wc_latency' else 0)
+    x_cols = n + numpy.arange(num_x)
+    rows_i = numpy.repeat(numpy.arange(n), n)
+    cols_j = numpy.tile(numpy.arange(n), n)
+
+    def matrix(rows, cols, vals, num_rows):
+        return coo_matrix((vals, (rows, cols)), shape = (num_rows, num_vars))
+
+    # Each switch is fully assigned.
+    assign = matrix(rows_i, x_cols, numpy.ones(num_x), n)
+    # Only to open controllers: x[i][j] - y[j] <= 0.
+    open_only = matrix(numpy.concatenate([numpy.arange(num_x), numpy.arange(num_x)]),
+                       numpy.concatenate([x_cols, cols_j]),
+                       numpy.concatenate([numpy.ones(num_x), -numpy.ones(num_x)]),
+                       num_x)
+    # Exactly k controllers.
+    count = matrix(numpy.zeros(n, dtype = int), numpy.arange(n), numpy.ones(n), 1)
+    constraints = [LinearConstraint(assign, 1, 1),
+                   LinearConstraint(open_only, -numpy.inf, 0),
+                   LinearConstraint(count, k, k)]
+
+    c = numpy.zeros(num_vars)
+    if objective == 'latency':
+        c[x_cols] = dist.ravel()
+    elif objective == 'wc_latency':
+        c[-1] = 1.0
+        radius = matrix(numpy.concatenate([rows_i, numpy.arange(n)]),
+                        numpy.concatenate([x_cols, numpy.full(n, num_vars - 1)]),
+                        numpy.concatenate([dist.ravel(), -numpy.ones(n)]), n)
+        constraints.append(LinearConstraint(radius, -numpy.inf, 0))
+    else:
+        raise Exception("invalid MILP objective: %s" % objective)
+
+    integrality = numpy.zeros(num_vars)
+    integrality[:n] = 1
+    upper = numpy.ones(num_vars)
+    if objective == 'wc_latency':
+        upper[-1] = numpy.inf
+    options = {}
+    if MILP_TIME_LIMIT:
+        options['time_limit'] = MILP_TIME_LIMIT
+
+    start_time = time.time()
+    result = milp(c, constraints = constraints, integrality = integrality,
+                  bounds = Bounds(numpy.zeros(num_vars), upper),
+                  options = options)
+    solve_time = time.time() - start_time
+    if result.x is None:
+        raise Exception("MILP solver found no solution: %s" % result.message)
+
+    combo = list(numpy.argsort(-result.x[:n])[:k])
+    nearest = dist[:, combo].min(axis = 1)
+    if objective == 'latency':
+        lowest = float(nearest.mean())
+    else:
+        lowest = float(nearest.max())
+    return {
+        'lowest': lowest,
+        'lowest_combo': sorted([dm.nodes[i] for i in combo]),
+        'mip_gap': float(getattr(result, 'mip_gap', 0.0) or 0.0),
+        'solve_time': solve_time,
+        'status': result.message
+    }
 
 
-        # Compute summary stats
-        for metric in metrics:
-            this_metric = metric_data[metric]
-            # Previously, we stored all values - but with so many,
-            # the storage of these values must go to disk swap and the CPU
-            # usage drops to 1% waiting on disk.
-            #this_metric['mean'] = sum(this_metric['values']) / len(this_metric['values'])
-            this_metric['mean'] = this_metric['sum'] / float(this_metric['num'])
-            if median:
-                this_metric['median'] = numpy.median(this_metric['values'])
-                del this_metric['values']
-            # Work around Python annoyance where str(set) doesn't work
-            this_metric['lowest_combo'] = list(this_metric['lowest_combo'])
-            this_metric['highest_combo'] = list(this_metric['highest_combo'])
-
-            if PRINT_VERBOSE:
-                print("\t" + "%s" % metric)
-                for key in sorted(this_metric.keys()):
-                    if key != 'values':
-                        print("\t\t%s: %s" % (key, this_metric[key]))
+def kmedian_milp(dm, k, context = None):
+    '''Find the combo with the lowest average latency with a MILP solver.'''
+    return placement_milp(dm, k, 'latency')
+
+
+def kcenter_milp(dm, k, context = None):
+    '''Find the combo with the lowest worst-case latency with a MILP solver.'''
+    return placement_milp(dm, k, 'wc_latency')
 
-        data['data'][str(combo_size)] = {}
-        group_data = data['data'][str(combo_size)]
-        for metric in metrics:
-            group_data[metric] = metric_data[metric]
-        group_data['distribution'] = distribution
+
+# Solvers for optimal combos, as alternatives to enumerating every combo.
+SOLVERS = ['enumerate', 'exact', 'milp']
+
+# Map of solver names to the metrics they support and functions to run them.
+# Functions must have these parameters:
+# (dm, k, context)
+# where context is an ExecutionContext with dm published, or None.
+# and return a dict with at least lowest and lowest_combo keys.
+SOLVER_FCNS = {
+    'exact': {
+        'latency': kmedian_bnb,
+        'wc_latency': kcenter_exact
+    },
+    'milp': {
+        'latency': kmedian_milp,
+        'wc_latency': kcenter_milp
+    }
+}
+
+
+def run_solver(solver, metrics, g, num_controllers, data, apsp,
+               processes = None, multiprocess = False, context = None):
+    '''Compute the optimal value and combo for each metric with a solver.
+
+    Fills in the same data['data'][k][metric] lowest and lowest_combo slots
+    as run_all_combos, plus the solver's duration and stats, without
+    evaluating every combo.
+
+    @param solver: solver name, in SOLVERS
+    @param metrics: metrics to optimize; each must be supported by solver
+    @param g: NetworkX graph
+    @param num_controllers: list of numbers of controllers to analyze.
+    @param data: JSON data to be augmented.
+    @param apsp: all-pairs shortest paths data
+    @param processes: number of workers in pool
+    @param multiprocess: use multiple processes, for solvers that can?
+    @param context: ExecutionContext whose pool to use when multiprocess is
+        set, or None to start (and stop) a pool of processes workers.
+    '''
+    for metric in metrics:
+        if metric not in SOLVER_FCNS[solver]:
+            raise Exception("solver %s does not support metric %s; choose from %s" %
+                            (solver, metric, list(SOLVER_FCNS[solver])))
+    dm = DistanceMatrix(g, apsp)
+    own_context = multiprocess and context is None
+    if own_context:
+        context = ExecutionContext(processes)
+    try:
+        if multiprocess:
+            # Workers attach to the shared matrix, rather than each task
+            # carrying a copy.
+            context.publish(metrics, g, dm, None, True, None)
+        else:
+            context = None
+        data['data'] = {}
+        for combo_size in sorted(num_controllers):
+            print("** combo size: %s" % combo_size)
+            group_data = {}
+            for metric in metrics:
+                start_time = time.time()
+                this_metric = SOLVER_FCNS[solver][metric](dm, combo_size,
+                                                          context)
+                this_metric['duration'] = time.time() - start_time
+                if PRINT_VERBOSE:
+                    print("\t" + "%s" % metric)
+                    for key in sorted(this_metric.keys()):
+                        print("\t\t%s: %s" % (key, this_metric[key]))
+                group_data[metric] = this_metric
+            group_data['distribution'] = []
+            data['data'][str(combo_size)] = group_data
+    finally:
+        if own_context:
+            context.close()
+        elif context is not None:
+            context.release()
 
     data['metric'] = metrics
     data['group'] = [str(c) for c in num_controllers]
 
-    # Pool cleanup.  According to the Multiprocessing module docs,
-    # this shouldn't be necessary due to automatic GC, but without this
-    # code, worker processes seem to accumulate until you're out of memory.
-    # Even if it's just a slow GC performance bug and not a correctness one,
-    # it helps run the code on smaller VMs and should help performance a bit.
-    if multiprocess:
-        print("terminating pool")
-        pool.terminate()
-        print("joining pool")
-        pool.join()
-
 
 def run_best_n(data, g, apsp, n, weighted):
     '''Use best of n runs
@@ -19,10 +19,11 @@ def do_cdfs(options, stats, write_filepath):
         for i, g in enumerate(stats['group']):
             if options.max and i >= options.max:
                 break
-            data[g] = [d[metric] for d in stats['data'][g]["distribution"]]
+            data[g] = plot.metric_distribution(stats, g, metric)
 
         print("plotting CDFs")
-        xmax = round(math.ceil(max(data[stats['group'][0]])))
+        x, y = plot.cdf_points(data[stats['group'][0]])
+        xmax = round(math.ceil(x[-1]))
         axis_limits = [0, xmax, 0, 1]
         if options.minx:
             axis_limits[0] = options.minx
@@ -15,7 +15,7 @@ def do_cloud(options, stats, write_filepath, ext = None):
     for i, g in enumerate(stats['group']):
         if options.max and i >= options.max:
             break
-        data[g] = [d for d in stats['data'][g]["distribution"]]
+        data[g] = plot.point_distribution(stats, g)
 
     print("plotting point cloud")
 
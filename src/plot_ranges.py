@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 '''Plot ranges, where each series is a # of controllers.'''
 from lib.options import parse_args
+from file_libs import decode_combo
 import lib.plot as plot
 from metrics_lib import metric_fullname, get_output_filepath, METRIC_FCNS
 from util import divide_def0
@@ -38,14 +39,16 @@ def abs_benefit_fcns_gen(stats, metric):
     aspect_fcns = {'abs_benefit': (lambda g, d, m: abs_benefits[g])}
     return aspect_fcns
 
-def ft_cost_fcn(g, d, m1, m2, graph):
+def ft_cost_fcn(g, d, m1, m2, graph, stats):
     '''
     m1 is the metric we use for comparison; m2 is the opponent.
+
+    @param stats: JSON data from run_all_combos, for decoding combos
     '''
-    m1_opt_combo = d[m1]['lowest_combo']
-    m2_opt_combo = d[m2]['lowest_combo']
-    apsp = nx.all_pairs_dijkstra_path_length(graph)
-    apsp_paths = nx.all_pairs_dijkstra_path(graph)
+    m1_opt_combo = decode_combo(stats, str(g), d[m1]['lowest_combo'])
+    m2_opt_combo = decode_combo(stats, str(g), d[m2]['lowest_combo'])
+    apsp = dict(nx.all_pairs_dijkstra_path_length(graph))
+    apsp_paths = dict(nx.all_pairs_dijkstra_path(graph))
     weighted = True
     extra_params = None
     m1_opt_m1_value = d[m1]['lowest']
@@ -71,7 +74,7 @@ def other_metric(metric):
     return other_metric
 
 def ft_cost_aspect_fcns_gen(stats, metric, graph):
-    aspect_fcns = {'ft_cost': (lambda g, d, m: ft_cost_fcn(g, d, metric, other_metric(m), graph))}
+    aspect_fcns = {'ft_cost': (lambda g, d, m: ft_cost_fcn(g, d, metric, other_metric(m), graph, stats))}
     return aspect_fcns
 
 # Master dict from plot types to all the info needed to construct them.
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+'''Streaming, mergeable quantile estimates in bounded memory.
+
+QuantileSketch is a KLL-style sketch (Karnin, Lang, Liberty, "Optimal
+Quantile Approximation in Streams", FOCS 2016): a stack of compactors, where
+level h holds values standing for 2^h inputs each.  When the sketch fills,
+a full level is sorted and every other value is promoted to the next level.
+
+Each compaction keeps the odd or even positions at random, which moves the
+estimated rank of any one value by 0 or +/-2^h, with mean zero.  The sketch
+sums 4^h over its compactions, which by Hoeffding's inequality bounds the
+rank error of any one quantile with a chosen confidence; rank_error()
+reports that bound, which is about 2 / k at 99% confidence.  The
+coins are seeded, so the same stream always gives the same answers.
+'''
+
+import math
+import random
+
+import numpy
+
+DEF_K = 200  # Capacity of the top compactor; memory is about 3 * k values.
+DEF_C = 2.0 / 3.0  # Ratio between capacities of adjacent compactors.
+DEF_CONFIDENCE = 0.99  # Probability that a quantile is within rank_error().
+
+
+class QuantileSketch(object):
+    '''Mergeable quantile sketch over a stream of numbers.'''
+
+    def __init__(self, k = DEF_K):
+        '''
+        @param k: capacity of the top compactor; rank error shrinks as 1 / k
+        '''
+        self.k = k
+        self.compactors = []  # Per-level arrays of values.
+        self.pending = []  # Single values not yet added to level 0.
+        self.num = 0  # Number of values added.
+        self.variance = 0  # Sum of squared max rank changes, over compactions.
+        self.random = random.Random(0)
+        self.grow()
+
+    def grow(self):
+        self.compactors.append(numpy.zeros(0))
+        self.max_size = sum([self.capacity(h)
+                             for h in range(len(self.compactors))])
+
+    def capacity(self, h):
+        '''Returns the number of values level h may hold before compaction.'''
+        depth = len(self.compactors) - h - 1
+        return int(math.ceil(self.k * DEF_C ** depth)) + 1
+
+    def size(self):
+        return sum([len(c) for c in self.compactors])
+
+    def add(self, value):
+        '''Add one value.'''
+        self.pending.append(value)
+        if len(self.pending) >= self.k:
+            self.flush()
+
+    def update(self, values):
+        '''Add a sequence of values.'''
+        values = numpy.asarray(values, dtype = float).ravel()
+        self.compactors[0] = numpy.concatenate([self.compactors[0], values])
+        self.num += len(values)
+        self.compress()
+
+    def flush(self):
+        '''Move values from add() into the compactors.'''
+        if self.pending:
+            pending = self.pending
+            self.pending = []
+            self.update(pending)
+
+    def compress(self):
+        '''Compact full levels until the sketch fits again.'''
+        h = 0
+        while self.size() >= self.max_size:
+            if len(self.compactors[h]) >= self.capacity(h):
+                if h + 1 == len(self.compactors):
+                    self.grow()
+                self.compact(h)
+            h = (h + 1) % len(self.compactors)
+
+    def compact(self, h):
+        '''Promote every other value of level h, by sorted order, to h + 1.'''
+        values = numpy.sort(self.compactors[h])
+        # An odd value out stays behind at this level.
+        keep = values[len(values) - len(values) % 2:]
+        values = values[:len(values) - len(values) % 2]
+        offset = self.random.randint(0, 1)
+        self.compactors[h + 1] = numpy.concatenate([self.compactors[h + 1],
+                                                    values[offset::2]])
+        self.compactors[h] = keep
+        self.variance += 4 ** h
+
+    def merge(self, other):
+        '''Fold other's values into this sketch.'''
+        self.flush()
+        other.flush()
+        while len(self.compactors) < len(other.compactors):
+            self.grow()
+        for h, values in enumerate(other.compactors):
+            self.compactors[h] = numpy.concatenate([self.compactors[h], values])
+        self.num += other.num
+        self.variance += other.variance
+        self.compress()
+
+    def weighted_values(self):
+        '''Returns (sorted values, cumulative weights) for rank queries.'''
+        values = numpy.concatenate(self.compactors)
+        weights = numpy.concatenate([numpy.full(len(c), 2 ** h, dtype = float)
+                                     for h, c in enumerate(self.compactors)])
+        order = numpy.argsort(values, kind = 'mergesort')
+        return values[order], numpy.cumsum(weights[order])
+
+    def quantile(self, q):
+        '''Returns the value estimated at fraction q in [0, 1] of the inputs.'''
+        return self.quantiles([q])[0]
+
+    def quantiles(self, qs):
+        '''Returns quantile(q) for each q in qs, sorting the sketch once.'''
+        self.flush()
+        if self.num == 0:
+            raise Exception("no values in quantile sketch")
+        values, cumulative = self.weighted_values()
+        total = cumulative[-1]
+        indices = numpy.searchsorted(cumulative, numpy.asarray(qs) * total)
+        return [float(values[min(i, len(values) - 1)]) for i in indices]
+
+    def rank_error(self, confidence = DEF_CONFIDENCE):
+        '''Returns the rank error bound, as a fraction of values added.
+
+        @param confidence: probability that any one quantile estimate is
+            within the bound
+        @return epsilon: the estimate for q lies between the true quantiles
+            for q - epsilon and q + epsilon
+        '''
+        self.flush()
+        if self.num == 0:
+            return 0.0
+        error = math.sqrt(2 * self.variance * math.log(2 / (1 - confidence)))
+        return min(1.0, error / self.num)
+
+    def to_json(self):
+        self.flush()
+        return {
+            'k': self.k,
+            'compactors': [c.tolist() for c in self.compactors],
+            'num': self.num,
+            'variance': self.variance
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        sketch = cls(data['k'])
+        for h in range(len(data['compactors']) - 1):
+            sketch.grow()
+        sketch.compactors = [numpy.array(c, dtype = float)
+                             for c in data['compactors']]
+        sketch.num = data['num']
+        sketch.variance = data['variance']
+        sketch.random.seed(sketch.num)
+        return sketch
@@ -1,13 +1,37 @@
 #!/usr/bin/env python
 import logging
+import math
+import os
+import shutil
+import tempfile
 import unittest
 
 import networkx as nx
+import numpy
 
-from itertools_recipes import choose
+from bisect import bisect_left, bisect_right
+from itertools import combinations
+
+from itertools_recipes import choose, combination_rank, combination_unrank
+from itertools_recipes import combinations_range
+from file_libs import decode_combo
 from lib.graph import set_unit_weights
 from metrics_lib import fairness, availability_one_combo
 from metrics_lib import link_failure_combinations, fraction_within_latency
+from metrics_lib import link_failure_state_prob, connectivity_sssp
+from metrics_lib import availability_polynomial, polynomial_availability
+from metrics_lib import availability_mc_one_combo, failure_depth
+from metrics_lib import DistanceMatrix, METRIC_FCNS, METRIC_FCNS_MATRIX
+from metrics_lib import BATCH_METRICS, batch_metrics, combo_blocks
+from metrics_lib import INCREMENTAL_METRICS, revolving_door_blocks
+from metrics_lib import kmedian_bnb, kcenter_exact, run_solver
+from metrics_lib import kmedian_milp, kcenter_milp
+import metrics_lib
+
+try:
+    from scipy.optimize import milp
+except ImportError:
+    milp = None
 from topo.os3e import OS3EGraph
 from os3e_weighted import OS3EWeightedGraph
 
@@ -117,6 +141,132 @@ class AvailabilityTest(unittest.TestCase):
                 self.assertTrue(c < 1.0)
                 self.assertAlmostEqual(get_coverage(max_failures), c)
 
+    def test_pruned_matches_all_failure_sets(self):
+        '''Skipping failure sets of unused links should not change results.'''
+        g = OS3EWeightedGraph()
+        apsp = dict(nx.all_pairs_dijkstra_path_length(g))
+        apsp_paths = dict(nx.all_pairs_dijkstra_path(g))
+        combo = ["Sunnyvale, CA", "Boston"]
+        for weighted, link_fail_prob in [(False, 0.01), (True, 0.00001)]:
+            exp_a = 0.0
+            exp_c = 0.0
+            for failures in range(3):
+                for failed_links in link_failure_combinations(g, failures):
+                    state_prob = link_failure_state_prob(g, failed_links,
+                        weighted, link_fail_prob)
+                    exp_c += state_prob
+                    exp_a += state_prob * connectivity_sssp(g, combo, apsp,
+                        apsp_paths, weighted, failed_links)
+            a, c = availability_one_combo(g, combo, apsp, apsp_paths,
+                                          weighted, link_fail_prob, 2)
+            self.assertAlmostEqual(exp_a, a)
+            self.assertAlmostEqual(exp_c, c)
+
+    def test_failure_depth(self):
+        '''Adaptive depth should stop once failure states cover the target.'''
+        g = OS3EGraph()
+        apsp = dict(nx.all_pairs_shortest_path_length(g))
+        apsp_paths = dict(nx.all_pairs_shortest_path(g))
+        fail_probs = [0.01] * g.number_of_edges()
+        self.assertEqual(failure_depth(fail_probs, 0.5), 0)
+        self.assertEqual(failure_depth(fail_probs, 0.999), 3)
+        self.assertEqual(failure_depth(fail_probs, 0.999, 2), 2)
+        combo = ["Sunnyvale, CA", "Boston"]
+        exp = availability_one_combo(g, combo, apsp, apsp_paths, False,
+                                     0.01, 3)
+        a, c = availability_one_combo(g, combo, apsp, apsp_paths, False,
+                                      0.01, None, 0.999)
+        self.assertAlmostEqual(exp[0], a)
+        self.assertAlmostEqual(exp[1], c)
+        self.assertTrue(c >= 0.999)
+
+    def test_depth_per_topology(self):
+        '''Per-depth availability shouldn't carry over between topologies
+        that share node names.'''
+        combo = ["Seattle", "Boston"]
+        extra_params = {'link_fail_prob': 0.01, 'max_failures': 2}
+        for g in [OS3EGraph(), OS3EWeightedGraph()]:
+            apsp = dict(nx.all_pairs_dijkstra_path_length(g))
+            apsp_paths = dict(nx.all_pairs_dijkstra_path(g))
+            exp, coverage = availability_one_combo(g, combo, apsp, apsp_paths,
+                                                   False, 0.01, 2)
+            got = METRIC_FCNS['availability_2'](g, combo, apsp, apsp_paths,
+                                                False, extra_params)
+            self.assertAlmostEqual(exp, got)
+
+    def test_reroute(self):
+        '''Rerouting availability should match per-failure-set components.'''
+        g = OS3EGraph()
+        apsp = dict(nx.all_pairs_shortest_path_length(g))
+        apsp_paths = dict(nx.all_pairs_shortest_path(g))
+        dm = DistanceMatrix(g, apsp, apsp_paths)
+        extra_params = {'link_fail_prob': 0.01, 'max_failures': 2}
+        for combo in [["Sunnyvale, CA", "Boston"], ["Portland"]]:
+            exp = 0.0
+            for failures in range(3):
+                for failed_links in link_failure_combinations(g, failures):
+                    h = g.copy()
+                    h.remove_edges_from(failed_links)
+                    reachable = set()
+                    for c in combo:
+                        reachable |= nx.node_connected_component(h, c)
+                    exp += (link_failure_state_prob(g, failed_links, False,
+                                                    0.01) *
+                            len(reachable) / float(g.number_of_nodes()))
+            got = METRIC_FCNS['availability_reroute'](g, combo, apsp,
+                apsp_paths, False, extra_params)
+            self.assertAlmostEqual(exp, got)
+            got = METRIC_FCNS_MATRIX['availability_reroute'](g, combo, dm,
+                apsp_paths, False, extra_params)
+            self.assertAlmostEqual(exp, got)
+            self.assertTrue(got >= METRIC_FCNS['availability'](g, combo, apsp,
+                apsp_paths, False, extra_params))
+
+    def test_polynomial(self):
+        '''One polynomial should give availability at every probability.'''
+        g = OS3EGraph()
+        apsp = dict(nx.all_pairs_shortest_path_length(g))
+        apsp_paths = dict(nx.all_pairs_shortest_path(g))
+        dm = DistanceMatrix(g, apsp, apsp_paths)
+        engine = dm.availability_engine(g, False, 0.01)
+        probs = [0.001, 0.01, 0.05]
+        for combo in [["Sunnyvale, CA", "Boston"], ["Portland"]]:
+            sums = availability_polynomial(g, combo, apsp, apsp_paths, 2)
+            for exp, got in zip(sums, engine.polynomial(dm.assign(combo), 2)):
+                self.assertAlmostEqual(exp, got)
+            a_all, c_all = polynomial_availability(sums, g.number_of_edges(),
+                                                   probs)
+            for i, link_fail_prob in enumerate(probs):
+                exp_a, exp_c = availability_one_combo(g, combo, apsp,
+                    apsp_paths, False, link_fail_prob, 2)
+                a, c = polynomial_availability(sums, g.number_of_edges(),
+                                               link_fail_prob)
+                self.assertAlmostEqual(exp_a, a)
+                self.assertAlmostEqual(exp_c, c)
+                self.assertAlmostEqual(a, a_all[i])
+                self.assertAlmostEqual(c, c_all[i])
+
+    def test_monte_carlo(self):
+        '''Sampled availability should land within its interval of exact.'''
+        g = OS3EGraph()
+        apsp = dict(nx.all_pairs_shortest_path_length(g))
+        apsp_paths = dict(nx.all_pairs_shortest_path(g))
+        for combo in [["Sunnyvale, CA", "Boston"], ["Portland"]]:
+            exp, coverage = availability_one_combo(g, combo, apsp, apsp_paths,
+                                                   False, 0.01, 3)
+            for bias in [1.0, 4.0]:
+                extra_params = {'link_fail_prob': 0.01, 'mc_precision': 0.002,
+                                'mc_confidence': 0.999, 'mc_bias': bias}
+                a, half_width, samples = availability_mc_one_combo(g, combo,
+                    apsp, apsp_paths, False, extra_params)
+                self.assertTrue(half_width <= 0.002)
+                # Exact availability leaves out states with > 3 failures.
+                self.assertTrue(exp - half_width <= a)
+                self.assertTrue(a <= exp + (1.0 - coverage) + half_width)
+                again = availability_mc_one_combo(g, combo, apsp, apsp_paths,
+                                                  False, extra_params)
+                self.assertEqual((a, half_width, samples), again)
+
     def test_os3e_weighted(self):
         '''Ensure unit-weighted version of graph yields same availability.'''
         link_fail_prob = 0.01
@@ -165,6 +315,568 @@ class LatencyTest(unittest.TestCase):
             self.assertEqual(two, len(combo) / float(g.number_of_nodes()))
 
 
+class DistanceMatrixTest(unittest.TestCase):
+
+    def test_os3e_matches_dict_metrics(self):
+        '''Matrix metric implementations should match dict-based ones.'''
+        extra_params = {'link_fail_prob': 0.01, 'max_failures': 1}
+        for g in [OS3EGraph(), OS3EWeightedGraph()]:
+            apsp = dict(nx.all_pairs_dijkstra_path_length(g))
+            apsp_paths = dict(nx.all_pairs_dijkstra_path(g))
+            dm = DistanceMatrix(g, apsp, apsp_paths)
+            combos = [["Sunnyvale, CA", "Boston"],
+                      ["Portland"],
+                      ["Sunnyvale, CA", "Salt Lake City", "Chicago"],
+                      ["Seattle", "Boston"],
+                      ["Seattle", "Portland"]]
+            for combo in combos:
+                for metric, fcn in METRIC_FCNS.items():
+                    if metric in metrics_lib.DEPTH_METRICS[2:]:
+                        continue  # Slow as dicts; see test_depth_metrics.
+                    exp = fcn(g, combo, apsp, apsp_paths, False, extra_params)
+                    got = METRIC_FCNS_MATRIX[metric](g, combo, dm, apsp_paths,
+                                                     False, extra_params)
+                    self.assertAlmostEqual(exp, got)
+
+    def test_availability_engine(self):
+        '''Bitmask availability should match the per-failure-set loop.'''
+        g = OS3EWeightedGraph()
+        apsp = dict(nx.all_pairs_dijkstra_path_length(g))
+        apsp_paths = dict(nx.all_pairs_dijkstra_path(g))
+        dm = DistanceMatrix(g, apsp, apsp_paths)
+        combos = [["Sunnyvale, CA", "Boston"],
+                  ["Portland"],
+                  ["Sunnyvale, CA", "Salt Lake City", "Chicago"]]
+        for weighted, link_fail_prob in [(False, 0.01), (True, 0.00001)]:
+            for combo in combos:
+                exp, coverage = availability_one_combo(g, combo, apsp,
+                    apsp_paths, weighted, link_fail_prob, 2)
+                engine = dm.availability_engine(g, weighted, link_fail_prob)
+                got = engine.availability(dm.assign(combo), 2)
+                self.assertAlmostEqual(exp, got)
+            masks, state_probs = engine.failure_sets(2)
+            self.assertEqual(len(masks), choose(g.number_of_edges(), 2))
+            failure_sets = link_failure_combinations(g, 2)
+            for i in [0, 17, len(failure_sets) - 1]:
+                self.assertAlmostEqual(state_probs[i] / link_failure_state_prob(
+                    g, failure_sets[i], weighted, link_fail_prob), 1.0)
+            self.assertTrue(dm.availability_engine(g, weighted,
+                                                   link_fail_prob) is engine)
+
+    def test_assignment_shared(self):
+        '''One assignment per combo, reused until the combo changes.'''
+        g = OS3EGraph()
+        dm = DistanceMatrix(g, dict(nx.all_pairs_shortest_path_length(g)))
+        combo = ["Seattle", "Portland"]
+        assignment = dm.assign(combo)
+        self.assertTrue(dm.assign(tuple(combo)) is assignment)
+        self.assertFalse(dm.assign(["Seattle", "Boston"]) is assignment)
+        # Seattle and Portland are adjacent, so each is one hop from the other
+        seattle = dm.index["Seattle"]
+        self.assertEqual(assignment.nearest[seattle], 0)
+        self.assertEqual(assignment.second[seattle], 1)
+        self.assertEqual(list(assignment.ties[seattle]), [True, False])
+
+    def test_os3e_batch_matches_matrix_metrics(self):
+        '''Batched metric values should match per-combo matrix values.'''
+        g = OS3EWeightedGraph()
+        apsp = dict(nx.all_pairs_dijkstra_path_length(g))
+        dm = DistanceMatrix(g, apsp, dict(nx.all_pairs_dijkstra_path(g)))
+        engine = dm.availability_engine(g, True, 0.00001)
+        dm.path_availability = engine.path_availability(1)
+        dm.depth_availability = engine.depth_availability(
+            metrics_lib.MAX_DEPTH_METRIC)
+        for combo_size in range(1, 4):
+            num = 0
+            for combos in combo_blocks(g.number_of_nodes(), combo_size, 1000):
+                values = batch_metrics(dm, combos, BATCH_METRICS)
+                for i, combo in enumerate(combos):
+                    combo = [dm.nodes[j] for j in combo]
+                    for metric in BATCH_METRICS:
+                        exp = METRIC_FCNS_MATRIX[metric](g, combo, dm, None,
+                                                         True, None)
+                        self.assertAlmostEqual(exp, values[metric][0][i])
+                num += len(combos)
+            self.assertEqual(num, choose(g.number_of_nodes(), combo_size))
+
+    def test_shared_attach(self):
+        '''An attached DistanceMatrix should view the same arrays.'''
+        g = OS3EWeightedGraph()
+        dm = DistanceMatrix(g, dict(nx.all_pairs_dijkstra_path_length(g)),
+                            dict(nx.all_pairs_dijkstra_path(g)))
+        dist = dm.dist.copy()
+        spec = dm.share()
+        try:
+            attached = DistanceMatrix.attach(spec)
+            self.assertTrue((attached.dist == dist).all())
+            self.assertEqual(attached.nodes, dm.nodes)
+            for i in range(len(dm.nodes)):
+                for j in range(len(dm.nodes)):
+                    self.assertEqual(attached.path(i, j).tolist(),
+                                     dm.path(i, j).tolist())
+            combo = dm.nodes[:3]
+            for metric in ['latency', 'congestion']:
+                self.assertAlmostEqual(
+                    METRIC_FCNS_MATRIX[metric](g, combo, dm, None, True, None),
+                    METRIC_FCNS_MATRIX[metric](g, combo, attached, None, True, None))
+        finally:
+            dm.unlink()
+        self.assertTrue((dm.dist == dist).all())
+
+    def test_os3e_revolving_door_matches_batch(self):
+        '''Incrementally-updated values should match batched values.'''
+        g = OS3EWeightedGraph()
+        dm = DistanceMatrix(g, dict(nx.all_pairs_dijkstra_path_length(g)))
+        for combo_size in range(1, 5):
+            seen = set([])
+            for combos, values in revolving_door_blocks(dm, combo_size,
+                                                        INCREMENTAL_METRICS, 500):
+                exp_values = batch_metrics(dm, combos, INCREMENTAL_METRICS)
+                for metric in INCREMENTAL_METRICS:
+                    for got, exp in zip(values[metric][0], exp_values[metric][0]):
+                        self.assertAlmostEqual(got, exp)
+                seen.update([tuple(c) for c in combos])
+            self.assertEqual(len(seen), choose(g.number_of_nodes(), combo_size))
+
+
+class SolverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.g = OS3EWeightedGraph()
+        self.apsp = dict(nx.all_pairs_dijkstra_path_length(self.g))
+        self.dm = DistanceMatrix(self.g, self.apsp)
+
+    def lowest(self, metric, combo_size):
+        '''Return the lowest metric value over all combos.'''
+        return min([batch_metrics(self.dm, combos, [metric])[metric][0].min()
+                    for combos in combo_blocks(len(self.dm.nodes), combo_size)])
+
+    def test_kmedian_bnb(self):
+        '''Branch-and-bound should match exhaustive enumeration.'''
+        iterations = metrics_lib.LAGRANGIAN_ITERATIONS
+        try:
+            # One subgradient step leaves a weak bound, so the search runs.
+            for metrics_lib.LAGRANGIAN_ITERATIONS in [1, iterations]:
+                for combo_size in range(1, 5):
+                    soln = kmedian_bnb(self.dm, combo_size)
+                    lowest = self.lowest('latency', combo_size)
+                    self.assertAlmostEqual(soln['lowest'], lowest)
+                    self.assertEqual(len(soln['lowest_combo']), combo_size)
+                    self.assertTrue(soln['lower_bound'] <= lowest + 1e-9)
+        finally:
+            metrics_lib.LAGRANGIAN_ITERATIONS = iterations
+
+    def test_kmedian_bnb_parallel(self):
+        '''Parallel subtree search should find the same optimum.'''
+        iterations = metrics_lib.LAGRANGIAN_ITERATIONS
+        metrics_lib.LAGRANGIAN_ITERATIONS = 1
+        try:
+            serial = kmedian_bnb(self.dm, 4)
+            with metrics_lib.ExecutionContext(2) as context:
+                context.publish(['latency'], self.g, self.dm, None, True, None)
+                parallel = kmedian_bnb(self.dm, 4, context)
+        finally:
+            metrics_lib.LAGRANGIAN_ITERATIONS = iterations
+        self.assertTrue(parallel['explored'] > 0)
+        self.assertAlmostEqual(serial['lowest'], parallel['lowest'])
+        self.assertEqual(serial['lowest_combo'], parallel['lowest_combo'])
+
+    def test_kcenter_exact(self):
+        '''Radius search should match exhaustive enumeration.'''
+        for combo_size in range(1, 5):
+            soln = kcenter_exact(self.dm, combo_size)
+            self.assertAlmostEqual(soln['lowest'],
+                                   self.lowest('wc_latency', combo_size))
+            self.assertEqual(len(set(soln['lowest_combo'])), combo_size)
+
+    @unittest.skipUnless(milp, "requires scipy.optimize.milp")
+    def test_milp(self):
+        '''MILP solutions should match exhaustive enumeration.'''
+        for combo_size in range(1, 4):
+            soln = kmedian_milp(self.dm, combo_size)
+            self.assertAlmostEqual(soln['lowest'], self.lowest('latency', combo_size))
+            self.assertAlmostEqual(soln['mip_gap'], 0.0)
+        for combo_size in range(1, 3):
+            soln = kcenter_milp(self.dm, combo_size)
+            self.assertAlmostEqual(soln['lowest'],
+                                   self.lowest('wc_latency', combo_size))
+
+    def test_run_solver(self):
+        '''Solver output should land in the usual lowest/lowest_combo slots.'''
+        data = {}
+        metrics = ['latency', 'wc_latency']
+        for multiprocess in [False, True]:
+            run_solver('exact', metrics, self.g, [1, 2], data, self.apsp, 2,
+                       multiprocess)
+            self.assertEqual(data['group'], ['1', '2'])
+            for combo_size in [1, 2]:
+                for metric in metrics:
+                    this_metric = data['data'][str(combo_size)][metric]
+                    self.assertAlmostEqual(this_metric['lowest'],
+                                           self.lowest(metric, combo_size))
+                    self.assertEqual(len(this_metric['lowest_combo']),
+                                     combo_size)
+
+
+class CombinationRankTest(unittest.TestCase):
+
+    def test_rank_unrank(self):
+        for n in range(7):
+            for k in range(n + 1):
+                for rank, combo in enumerate(combinations(range(n), k)):
+                    self.assertEqual(combination_rank(combo, n), rank)
+                    self.assertEqual(combination_unrank(rank, n, k), combo)
+
+    def test_combinations_range(self):
+        all_combos = list(combinations(range(8), 3))
+        for lo in range(len(all_combos) + 1):
+            for hi in range(lo, len(all_combos) + 1, 7):
+                self.assertEqual(list(combinations_range(8, 3, lo, hi)),
+                                 all_combos[lo:hi])
+
+    def test_combo_blocks_range(self):
+        blocks = list(combo_blocks(10, 3, 16, 20, 75))
+        got = [tuple(c) for block in blocks for c in block]
+        self.assertEqual(got, list(combinations(range(10), 3))[20:75])
+
+
+class RunAllCombosTest(unittest.TestCase):
+
+    def run_os3e(self, metrics, multiprocess, weighted = True, **kwargs):
+        g = OS3EWeightedGraph()
+        if not weighted:
+            set_unit_weights(g)
+        apsp = nx.all_pairs_dijkstra_path_length(g)
+        apsp_paths = nx.all_pairs_dijkstra_path(g)
+        extra_params = {'link_fail_prob': 0.0001, 'max_failures': 1}
+        data = {}
+        metrics_lib.run_all_combos(metrics, g, [1, 2], data, apsp, apsp_paths,
+                                   True, True, True, extra_params, 2,
+                                   multiprocess, 25, True, **kwargs)
+        return data
+
+    def assertSameData(self, metrics, exp, got):
+        for combo_size in ['1', '2']:
+            for metric in metrics:
+                exp_metric = exp['data'][combo_size][metric]
+                got_metric = got['data'][combo_size][metric]
+                for key in ['lowest', 'highest', 'mean']:
+                    self.assertAlmostEqual(exp_metric[key], got_metric[key])
+                self.assertEqual(exp_metric['num'], got_metric['num'])
+            exp_dist = sorted(exp['data'][combo_size]['distribution'],
+                              key = lambda d: d['id'])
+            got_dist = sorted(got['data'][combo_size]['distribution'],
+                              key = lambda d: d['id'])
+            for metric in metrics:
+                values = [point[metric] for point in exp_dist]
+                self.assertQuantiles(exp['data'][combo_size][metric], values)
+                self.assertQuantiles(got['data'][combo_size][metric], values)
+            self.assertEqual(len(exp_dist), len(got_dist))
+            for exp_point, got_point in zip(exp_dist, got_dist):
+                self.assertEqual(list(exp_point['combo']), list(got_point['combo']))
+                for metric in metrics:
+                    self.assertAlmostEqual(exp_point[metric], got_point[metric])
+
+    def assertQuantiles(self, metric_data, values):
+        '''Sketched quantiles should be within their stated rank error.'''
+        values = sorted(values)
+        n = float(len(values))
+        epsilon = metric_data['quantile_rank_error'] + 1 / n
+        quantiles = [('median', 0.5)]
+        quantiles += [('p%s' % p, p / 100.0) for p in metrics_lib.PERCENTILES]
+        for key, q in quantiles:
+            value = metric_data[key]
+            self.assertTrue(bisect_left(values, value) / n <= q + epsilon)
+            self.assertTrue(bisect_right(values, value) / n >= q - epsilon)
+
+    def test_fine_grained_multiprocess(self):
+        '''Streaming fine-grained dispatch should match a serial run.'''
+        coarse = metrics_lib.COARSE
+        metrics_lib.COARSE = False
+        try:
+            for metrics in [['latency', 'fairness'], ['latency', 'congestion']]:
+                self.assertSameData(metrics, self.run_os3e(metrics, False),
+                                    self.run_os3e(metrics, True))
+        finally:
+            metrics_lib.COARSE = coarse
+
+    def test_coarse_multiprocess(self):
+        '''Rank-sharded coarse dispatch should match a serial run.'''
+        coarse = metrics_lib.COARSE
+        metrics_lib.COARSE = True
+        try:
+            for metrics in [['latency', 'fairness'], ['latency', 'congestion']]:
+                self.assertSameData(metrics, self.run_os3e(metrics, False),
+                                    self.run_os3e(metrics, True))
+        finally:
+            metrics_lib.COARSE = coarse
+
+    def test_histogram_distribution(self):
+        '''Merged histograms should count exactly the serial values.'''
+        metrics = ['latency', 'fairness']
+        for weighted in [True, False]:
+            exp = self.run_os3e(metrics, False, weighted = weighted)
+            for multiprocess in [False, True]:
+                got = self.run_os3e(metrics, multiprocess, weighted = weighted,
+                                    dist_format = 'histogram')
+                for combo_size in ['1', '2']:
+                    histograms = got['data'][combo_size]['distribution']
+                    for metric in metrics:
+                        histogram = histograms[metric]
+                        width = histogram['bin_width']
+                        counts = {}
+                        for point in exp['data'][combo_size]['distribution']:
+                            key = str(int(math.floor(point[metric] / width)))
+                            counts[key] = counts.get(key, 0) + 1
+                        self.assertEqual(histogram['counts'], counts)
+                if not weighted:
+                    # Mean hop counts shouldn't collapse into a few
+                    # one-hop-wide bins.
+                    latencies = set(point['latency'] for point in
+                                    exp['data']['2']['distribution'])
+                    counts = got['data']['2']['distribution']['latency']
+                    self.assertEqual(len(counts['counts']), len(latencies))
+
+    def test_npy_distribution(self):
+        '''Column files should hold the serial values, found by rank.'''
+        metrics = ['latency', 'wc_latency']
+        exp = self.run_os3e(metrics, False)
+        dist_path = tempfile.mkdtemp()
+        try:
+            for multiprocess, enumeration in [(False, 'lexicographic'),
+                                              (True, 'lexicographic'),
+                                              (False, 'revolving_door')]:
+                got = self.run_os3e(metrics, multiprocess,
+                                    enumeration = enumeration,
+                                    dist_format = 'npy', dist_path = dist_path)
+                point_id = 0
+                for combo_size in ['1', '2']:
+                    columns = got['data'][combo_size]['distribution']
+                    ranks = numpy.load(columns['columns']['rank'])
+                    points = exp['data'][combo_size]['distribution']
+                    self.assertEqual(columns['rows'], len(points))
+                    self.assertEqual(sorted(ranks.tolist()),
+                                     list(range(len(points))))
+                    for metric in metrics:
+                        values = numpy.load(columns['columns'][metric])
+                        by_rank = numpy.zeros(len(points))
+                        by_rank[ranks] = values
+                        for point in points:
+                            self.assertAlmostEqual(
+                                by_rank[point['id'] - point_id], point[metric])
+                    point_id += len(points)
+        finally:
+            shutil.rmtree(dist_path)
+
+    def test_rank_combos(self):
+        '''Combos written as ranks should decode to the names written.'''
+        metrics = ['latency', 'fairness']
+        exp = self.run_os3e(metrics, False)
+        for multiprocess in [False, True]:
+            got = self.run_os3e(metrics, multiprocess, combo_format = 'rank')
+            for combo_size in ['1', '2']:
+                for metric in metrics:
+                    for key in ['lowest_combo', 'highest_combo']:
+                        combo = got['data'][combo_size][metric][key]
+                        self.assertTrue(isinstance(combo, int))
+                        self.assertEqual(
+                            sorted(exp['data'][combo_size][metric][key]),
+                            decode_combo(got, combo_size, combo))
+                exp_dist = exp['data'][combo_size]['distribution']
+                got_dist = got['data'][combo_size]['distribution']
+                exp_combos = dict((d['id'], sorted(d['combo']))
+                                  for d in exp_dist)
+                for point in got_dist:
+                    self.assertEqual(exp_combos[point['id']],
+                                     decode_combo(got, combo_size,
+                                                  point['combo']))
+
+    def test_rank_combos_ft_cost(self):
+        '''Plotting from a rank-format stats file should decode its combos.'''
+        from file_libs import read_json_file, write_json_file
+        from plot_ranges import ft_cost_fcn
+        metrics = ['latency', 'latency_2']
+        exp = self.run_os3e(metrics, False)
+        got = self.run_os3e(metrics, False, combo_format = 'rank')
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'stats.json')
+            write_json_file(filename, got)
+            got = read_json_file(filename)
+        finally:
+            shutil.rmtree(tmpdir)
+        g = OS3EWeightedGraph()
+        for combo_size in ['1', '2']:
+            self.assertAlmostEqual(
+                ft_cost_fcn(combo_size, exp['data'][combo_size], 'latency',
+                            'latency_2', g, exp),
+                ft_cost_fcn(combo_size, got['data'][combo_size], 'latency',
+                            'latency_2', g, got))
+
+    def test_availability_table(self):
+        '''Availability from the shared path table should match each combo's
+        own failure-set loop.'''
+        metrics = ['latency', 'availability']
+        exp = self.run_os3e(metrics, False)
+        got = self.run_os3e(metrics, True)
+        self.assertSameData(metrics, exp, got)
+        g = OS3EWeightedGraph()
+        apsp = dict(nx.all_pairs_dijkstra_path_length(g))
+        apsp_paths = dict(nx.all_pairs_dijkstra_path(g))
+        for point in exp['data']['2']['distribution'][:50]:
+            availability, coverage = availability_one_combo(g, point['combo'],
+                apsp, apsp_paths, True, 0.0001, 1)
+            self.assertAlmostEqual(availability, point['availability'])
+
+    def test_depth_metrics(self):
+        '''Availability at every depth should come from one run, matching
+        each depth's own failure-set loop.'''
+        metrics = ['availability', 'availability_1', 'availability_2']
+        exp = self.run_os3e(metrics, False)
+        got = self.run_os3e(metrics, True)
+        self.assertSameData(metrics, exp, got)
+        g = OS3EWeightedGraph()
+        apsp = dict(nx.all_pairs_dijkstra_path_length(g))
+        apsp_paths = dict(nx.all_pairs_dijkstra_path(g))
+        for point in exp['data']['2']['distribution'][:20]:
+            self.assertAlmostEqual(point['availability'],
+                                   point['availability_1'])
+            availability, coverage = availability_one_combo(g, point['combo'],
+                apsp, apsp_paths, True, 0.0001, 2)
+            self.assertAlmostEqual(availability, point['availability_2'])
+            depth = metrics_lib.get_availability_depth(g, point['combo'], apsp,
+                apsp_paths, True, {'link_fail_prob': 0.0001}, 2)
+            self.assertAlmostEqual(availability, depth)
+
+    def test_reroute_workers(self):
+        '''Workers should see the same rerouting failure states.'''
+        metrics = ['latency', 'availability_reroute']
+        exp = self.run_os3e(metrics, False)
+        got = self.run_os3e(metrics, True)
+        self.assertSameData(metrics, exp, got)
+
+    def test_monte_carlo_seeds(self):
+        '''Sampled availability shouldn't depend on which worker runs a combo.'''
+        metrics = ['availability_mc']
+        exp = self.run_os3e(metrics, False)
+        got = self.run_os3e(metrics, True)
+        self.assertSameData(metrics, exp, got)
+
+    def test_shared_context(self):
+        '''One ExecutionContext should serve runs on different topologies.'''
+        metrics = ['latency', 'congestion']
+        coarse = metrics_lib.COARSE
+        try:
+            with metrics_lib.ExecutionContext(2) as context:
+                for metrics_lib.COARSE in [True, False]:
+                    for weighted in [True, False]:
+                        exp = self.run_os3e(metrics, False, weighted = weighted)
+                        got = self.run_os3e(metrics, True, weighted = weighted,
+                                            context = context)
+                        self.assertSameData(metrics, exp, got)
+        finally:
+            metrics_lib.COARSE = coarse
+
+    def test_crash_frees_shared_memory(self):
+        '''A failing run should still stop its pool and free shared memory.'''
+        if not os.path.isdir('/dev/shm'):
+            self.skipTest("no /dev/shm to check for leaked blocks")
+        def blocks():
+            return set(os.listdir('/dev/shm'))
+        def crash(*args):
+            raise Exception("simulated crash")
+        congestion = METRIC_FCNS_MATRIX['congestion']
+        METRIC_FCNS_MATRIX['congestion'] = crash
+        before = blocks()
+        try:
+            self.assertRaises(Exception, self.run_os3e, ['congestion'], True)
+        finally:
+            METRIC_FCNS_MATRIX['congestion'] = congestion
+        self.assertEqual(blocks() - before, set())
+
+    def test_crash_fine_grained(self):
+        '''A worker failing mid-stream should not hang the pool shutdown.'''
+        if not os.path.isdir('/dev/shm'):
+            self.skipTest("no /dev/shm to check for leaked blocks")
+        def crash(*args):
+            raise Exception("simulated crash")
+        congestion = METRIC_FCNS_MATRIX['congestion']
+        METRIC_FCNS_MATRIX['congestion'] = crash
+        coarse = metrics_lib.COARSE
+        metrics_lib.COARSE = False
+        before = set(os.listdir('/dev/shm'))
+        try:
+            # Many more blocks than may be in flight at once.
+            self.assertRaises(Exception, self.run_os3e, ['congestion'], True)
+        finally:
+            METRIC_FCNS_MATRIX['congestion'] = congestion
+            metrics_lib.COARSE = coarse
+        self.assertEqual(set(os.listdir('/dev/shm')) - before, set())
+
+    def test_resume(self):
+        '''A run resumed from a checkpoint should match an uninterrupted one.'''
+        metrics = ['latency', 'wc_latency']
+        exp = self.run_os3e(metrics, False)
+        tmp_dir = tempfile.mkdtemp()
+        checkpoint = os.path.join(tmp_dir, 'run.checkpoint.json')
+        checkpoint_combos = metrics_lib.CHECKPOINT_COMBOS
+        write_checkpoint = metrics_lib.write_checkpoint
+        batch_metrics = metrics_lib.batch_metrics
+        writes = []
+        def crashing_write_checkpoint(filepath, checkpoint_data):
+            write_checkpoint(filepath, checkpoint_data)
+            writes.append(checkpoint_data['position'])
+            if len(writes) == 2:
+                raise RuntimeError("simulated crash")
+        evaluated = []
+        def counting_batch_metrics(dm, combos, metrics):
+            evaluated.append(len(combos))
+            return batch_metrics(dm, combos, metrics)
+        dist_path = os.path.join(tmp_dir, 'dist')
+        metrics_lib.CHECKPOINT_COMBOS = 300
+        try:
+            # Each checkpoint would rewrite a JSON distribution whole.
+            self.assertRaises(Exception, self.run_os3e, metrics, False,
+                              checkpoint = checkpoint)
+            metrics_lib.write_checkpoint = crashing_write_checkpoint
+            self.assertRaises(RuntimeError, self.run_os3e, metrics, False,
+                              checkpoint = checkpoint, checkpoint_interval = 0,
+                              dist_format = 'npy', dist_path = dist_path)
+            self.assertTrue(os.path.exists(checkpoint))
+            metrics_lib.write_checkpoint = write_checkpoint
+            metrics_lib.batch_metrics = counting_batch_metrics
+            got = self.run_os3e(metrics, False, checkpoint = checkpoint,
+                                resume = True, checkpoint_interval = 0,
+                                dist_format = 'npy', dist_path = dist_path)
+            for combo_size in ['1', '2']:
+                for metric in metrics:
+                    exp_metric = exp['data'][combo_size][metric]
+                    got_metric = got['data'][combo_size][metric]
+                    for key in ['lowest', 'highest', 'mean']:
+                        self.assertAlmostEqual(exp_metric[key], got_metric[key])
+                    self.assertEqual(exp_metric['num'], got_metric['num'])
+                columns = got['data'][combo_size]['distribution']
+                points = exp['data'][combo_size]['distribution']
+                ids = (numpy.load(columns['columns']['rank']) +
+                       columns['point_id'])
+                for metric in metrics:
+                    values = dict(zip(ids.tolist(),
+                                      numpy.load(columns['columns'][metric])))
+                    for point in points:
+                        self.assertAlmostEqual(values[point['id']],
+                                               point[metric])
+        finally:
+            metrics_lib.CHECKPOINT_COMBOS = checkpoint_combos
+            metrics_lib.write_checkpoint = write_checkpoint
+            metrics_lib.batch_metrics = batch_metrics
+            shutil.rmtree(tmp_dir)
+        # Only the combos after the last checkpoint are evaluated again.
+        num_nodes = OS3EWeightedGraph().number_of_nodes()
+        remaining = choose(num_nodes, 2) - writes[-1]
+        self.assertEqual(sum(evaluated), remaining)
+        self.assertFalse(os.path.exists(checkpoint))
+
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
     unittest.main()
\ No newline at end of file
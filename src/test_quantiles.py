@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+'''Validate streaming quantile sketches.'''
+
+import logging
+import unittest
+
+import numpy
+
+from quantiles import QuantileSketch
+
+
+lg = logging.getLogger("test_quantiles")
+
+QS = [0.01, 0.05, 0.5, 0.95, 0.99]
+
+
+class QuantileSketchTest(unittest.TestCase):
+
+    def assertWithinRankError(self, sketch, values):
+        values = numpy.sort(values)
+        epsilon = sketch.rank_error() + 1.0 / len(values)
+        for q, estimate in zip(QS, sketch.quantiles(QS)):
+            rank = numpy.searchsorted(values, estimate) / float(len(values))
+            self.assertTrue(abs(rank - q) <= epsilon)
+
+    def test_small_is_exact(self):
+        sketch = QuantileSketch()
+        for value in range(100):
+            sketch.add(value)
+        self.assertEqual(sketch.rank_error(), 0.0)
+        self.assertEqual(sketch.quantile(0.5), 49)
+        self.assertEqual(sketch.quantile(0.0), 0)
+        self.assertEqual(sketch.quantile(1.0), 99)
+
+    def test_stream(self):
+        values = numpy.random.RandomState(1).lognormal(size = 200000)
+        sketch = QuantileSketch()
+        for i in range(0, len(values), 4096):
+            sketch.update(values[i:i + 4096])
+        self.assertEqual(sketch.num, len(values))
+        self.assertTrue(sketch.size() < 5 * sketch.k)
+        self.assertTrue(sketch.rank_error() < 0.02)
+        self.assertWithinRankError(sketch, values)
+
+    def test_merge(self):
+        values = numpy.random.RandomState(2).normal(size = 100000)
+        sketches = [QuantileSketch() for i in range(8)]
+        for i, chunk in enumerate(numpy.array_split(values, 64)):
+            sketches[i % 8].update(chunk)
+        merged = sketches[0]
+        for sketch in sketches[1:]:
+            merged.merge(sketch)
+        self.assertEqual(merged.num, len(values))
+        self.assertWithinRankError(merged, values)
+
+    def test_json_round_trip(self):
+        sketch = QuantileSketch()
+        sketch.update(numpy.arange(10000.0))
+        sketch.add(5.5)
+        copy = QuantileSketch.from_json(sketch.to_json())
+        self.assertEqual(copy.quantiles(QS), sketch.quantiles(QS))
+        self.assertEqual(copy.rank_error(), sketch.rank_error())
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    unittest.main()
@@ -51,8 +51,8 @@ WRITE_COMBOS = True
 # Max #  Failures to consider.
 MAX_FAILURES = 3
 
-# Metrics to compute
-METRICS = ['availability']
+# Metrics to compute: availability at each depth, all from one sweep.
+METRICS = [metrics.depth_metric(f) for f in range(1, MAX_FAILURES + 1)]
 
 # Pull in previously computed data, rather than recompute?
 USE_PRIOR_OPTS = False
@@ -81,42 +81,39 @@ if COMPUTE_END:
     controllers += (range(g.number_of_nodes() - NUM_FROM_END + 1, g.number_of_nodes() + 1))
 
 if WEIGHTED:
-    apsp = nx.all_pairs_dijkstra_path_length(g)
-    apsp_paths = nx.all_pairs_dijkstra_path(g)
+    apsp = dict(nx.all_pairs_dijkstra_path_length(g))
+    apsp_paths = dict(nx.all_pairs_dijkstra_path(g))
 else:
-    apsp = nx.all_pairs_shortest_path_length(g)
-    apsp_paths = nx.all_pairs_shortest_path(g)
+    apsp = dict(nx.all_pairs_shortest_path_length(g))
+    apsp_paths = dict(nx.all_pairs_shortest_path(g))
 
 if USE_PRIOR_OPTS:
     data = read_json_file(PRIOR_OPTS_FILENAME)
 else:
-    all_data = {}  # data, keyed by # failures
-    for failures in range(1, MAX_FAILURES + 1):
-        # data['data'][num controllers] = [latency:latency, nodes:[best-pos node(s)]]
-        # data['metrics'] = [list of metrics included]
-        # latency is also equal to 1/closeness centrality.
-        all_data[failures] = {}
-        extra_params['max_failures'] = failures
-        metrics.run_all_combos(METRICS, g, controllers, all_data[failures], apsp,
+    # data['data'][num controllers] = [latency:latency, nodes:[best-pos node(s)]]
+    # data['metrics'] = [list of metrics included]
+    # Each point has availability for every depth, from a single run.
+    data = {}
+    metrics.run_all_combos(METRICS, g, controllers, data, apsp,
                            apsp_paths, WEIGHTED, WRITE_DIST, WRITE_COMBOS, extra_params)
     # extract ordering of availability
     extract = {}  # extract[1] = data for 1 failure
     failures = range(1, MAX_FAILURES + 1)
     for j in failures:
         extract[j] = []
-        print "getting data for %i failure" % j
-        for i, point in enumerate(all_data[j]['data'][str(1)]['distribution']):
+        print("getting data for %i failure" % j)
+        for i, point in enumerate(data['data'][str(1)]['distribution']):
             id = point['id']
             combo = point['combo']
-            a = point['availability']
+            a = point[metrics.depth_metric(j)]
             extract[j].append([id, a, combo])
         extract[j] =  sorted(extract[j], key = itemgetter(1), reverse = True)
     for combo in combinations(failures, 2):
-        print "comparing %s and %s:" % (combo[0], combo[1])
+        print("comparing %s and %s:" % (combo[0], combo[1]))
         left = combo[0]
         right = combo[1]
         for i in range(len(extract[left])):
-            print "\t%s %s:%0.6f %s:%0.6f" % (extract[left][i][0], extract[left][i][2], extract[left][i][1], extract[right][i][2], extract[right][i][1])
-        print "list similarity: %f" % compare_lists([i[0] for i in extract[left]], [i[0] for i in extract[right]])
+            print("\t%s %s:%0.6f %s:%0.6f" % (extract[left][i][0], extract[left][i][2], extract[left][i][1], extract[right][i][2], extract[right][i][1]))
+        print("list similarity: %f" % compare_lists([i[0] for i in extract[left]], [i[0] for i in extract[right]]))
 
 